@@ -0,0 +1,61 @@
+"""
+Measures the memory each Company instance costs and the time it takes to construct one, on top of the parsed
+dictionaries it's built from.
+
+    python -m benchmarks.company --count 100000
+"""
+import argparse
+import copy
+import gc
+import time
+import tracemalloc
+from safer.crawler import parse_html_to_tree
+from safer.html import process_company_snapshot
+from safer.results import Company
+from benchmarks.run import load_fixtures
+
+
+def run(count):
+    snapshots, _ = load_fixtures()
+    parsed = [process_company_snapshot(parse_html_to_tree(page)) for page in snapshots]
+    # The dictionaries are built before measuring, only what Company itself costs is measured
+    dictionaries = [copy.deepcopy(parsed[i % len(parsed)]) for i in range(count)]
+
+    gc.collect()
+    start = time.perf_counter()
+    companies = [Company(data) for data in dictionaries]
+    construction = (time.perf_counter() - start) / count
+    del companies
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    companies = [Company(data) for data in dictionaries]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # The list holding the companies costs a pointer per company
+    per_instance = (after - before) / count - 8
+
+    dates_start = time.perf_counter()
+    for company in companies:
+        _ = (company.latest_update, company.mcs_150_form_date, company.out_of_service_date)
+    dates = (time.perf_counter() - dates_start) / count
+
+    return {
+        "count": count,
+        "bytes_per_instance": round(per_instance, 1),
+        "construction_us": round(construction * 1e6, 2),
+        "first_date_access_us": round(dates * 1e6, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=100000, help="Number of Company instances to build")
+    args = parser.parse_args()
+    for name, value in run(args.count).items():
+        print("{:<24}{:>12}".format(name, value))
+
+
+if __name__ == "__main__":
+    main()
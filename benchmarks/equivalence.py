@@ -0,0 +1,107 @@
+"""
+Checks that the parser's output on the fixtures is identical to the output recorded next to them, so a change to the
+parsing that's meant to only make it faster can be proven to not change its results.
+
+    python -m benchmarks.equivalence
+    python -m benchmarks.equivalence --update
+
+Every fixture page has its expected output in a .expected.json file of the same name. --update records the output of
+the current parser as the expected one, after recording new fixtures or after a change meant to alter the output.
+"""
+import argparse
+import json
+import sys
+from lxml import etree, html
+from safer.crawler import parse_html_to_tree
+from safer.html import process_company_snapshot, process_search_result_html
+from benchmarks.run import FIXTURES_DIRECTORY
+
+
+def parse_fixture(path):
+    """
+    :param path: Path of a snapshot_*.html or search_*.html fixture.
+    :return: Output of process_company_snapshot or process_search_result_html for the page.
+    """
+    tree = parse_html_to_tree(path.read_text(encoding="latin-1"))
+    if path.name.startswith("snapshot_"):
+        return process_company_snapshot(tree)
+    return process_search_result_html(tree)
+
+
+def expected_path(path):
+    return path.with_name(path.stem + ".expected.json")
+
+
+def serialize(value):
+    # The search result rows are kept as elements and serialized when needed, so they're compared serialized
+    if isinstance(value, etree._Element):  # pylint: disable=protected-access
+        value = html.tostring(value, pretty_print=True)
+    if isinstance(value, bytes):
+        return value.decode("ascii")
+    return str(value)
+
+
+def dump_output(output):
+    return json.dumps(output, indent=2, sort_keys=True, ensure_ascii=False, default=serialize) + "\n"
+
+
+def differences(expected, actual, path=""):
+    """
+    :return: List of (path, expected, actual) tuples of the values that differ.
+    """
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        found = []
+        for key in sorted(set(expected) | set(actual)):
+            found += differences(expected.get(key), actual.get(key), "{}.{}".format(path, key) if path else key)
+        return found
+    if isinstance(expected, list) and isinstance(actual, list) and len(expected) == len(actual):
+        found = []
+        for i, (e, a) in enumerate(zip(expected, actual)):
+            found += differences(e, a, "{}[{}]".format(path, i))
+        return found
+    return [] if expected == actual else [(path, expected, actual)]
+
+
+def check(directory=FIXTURES_DIRECTORY, update=False):
+    """
+    :return: Dictionary of the differences found per fixture, empty if the output is identical on every fixture.
+    """
+    fixtures = sorted(directory.glob("snapshot_*.html")) + sorted(directory.glob("search_*.html"))
+    if not fixtures:
+        raise FileNotFoundError("No fixtures in {}, record some with benchmarks.record".format(directory))
+    found = {}
+    for path in fixtures:
+        # Round tripped through JSON so it's compared the way it's stored
+        actual = json.loads(dump_output(parse_fixture(path)))
+        if update:
+            expected_path(path).write_text(dump_output(actual), encoding="utf-8")
+            continue
+        if not expected_path(path).exists():
+            found[path.name] = [("", "no expected output, record it with --update", None)]
+            continue
+        expected = json.loads(expected_path(path).read_text(encoding="utf-8"))
+        diff = differences(expected, actual)
+        if diff:
+            found[path.name] = diff
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--update", action="store_true", help="Record the current output as the expected one")
+    args = parser.parse_args()
+    found = check(update=args.update)
+    if args.update:
+        print("recorded the expected output of every fixture")
+        return 0
+    for name, diff in found.items():
+        for path, expected, actual in diff:
+            print("{} {}: expected {!r}, got {!r}".format(name, path, expected, actual))
+    if found:
+        return 1
+    print("output identical on every fixture")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,37 @@
+"""
+Records Company Snapshot and search result pages from SAFER into benchmarks/fixtures, so the benchmarks can be run
+offline against real pages.
+
+    python -m benchmarks.record --usdot 698887 2346443 --search python transport
+"""
+import argparse
+from pathlib import Path
+from safer.api import api_call_get_usdot, api_call_search
+
+FIXTURES_DIRECTORY = Path(__file__).parent / "fixtures"
+
+
+def record(usdots, names, directory=FIXTURES_DIRECTORY):
+    directory.mkdir(parents=True, exist_ok=True)
+    for usdot in usdots:
+        r = api_call_get_usdot(usdot)
+        r.raise_for_status()
+        (directory / "snapshot_{}.html".format(usdot)).write_bytes(r.content)
+        print("recorded snapshot {}".format(usdot))
+    for name in names:
+        r = api_call_search(name)
+        r.raise_for_status()
+        (directory / "search_{}.html".format(name.lower().replace(" ", "_"))).write_bytes(r.content)
+        print("recorded search {}".format(name))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--usdot", nargs="*", type=int, default=[], help="USDOT Numbers to record snapshots of")
+    parser.add_argument("--search", nargs="*", default=[], help="Names to record search results of")
+    args = parser.parse_args()
+    record(args.usdot, args.search)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Offline benchmarks of the parsing stages, run against the pages in benchmarks/fixtures.
+
+Every stage is timed on its own and its throughput, p50/p99 latency and peak memory per call are reported.
+The results can be saved as a baseline and later runs compared against it:
+
+    python -m benchmarks.run --save baseline.json
+    python -m benchmarks.run --compare baseline.json
+"""
+import argparse
+import copy
+import json
+import platform
+import time
+import tracemalloc
+from pathlib import Path
+import safer.html
+from safer.crawler import parse_html_to_tree, parse_page
+from safer.html import process_company_snapshot, process_final_dictionary, process_search_result_html
+from safer.results import Company
+
+FIXTURES_DIRECTORY = Path(__file__).parent / "fixtures"
+
+
+def load_fixtures(directory=FIXTURES_DIRECTORY):
+    """
+    :return: Tuple of the snapshot pages and the search result pages, as strings.
+    """
+    snapshots = [p.read_text(encoding="latin-1") for p in sorted(directory.glob("snapshot_*.html"))]
+    searches = [p.read_text(encoding="latin-1") for p in sorted(directory.glob("search_*.html"))]
+    if not snapshots or not searches:
+        raise FileNotFoundError("No fixtures in {}, record some with benchmarks.record".format(directory))
+    return snapshots, searches
+
+
+def capture_unprocessed_dictionaries(trees):
+    """
+    Runs process_company_snapshot and captures the dictionaries it hands to process_final_dictionary.
+    """
+    captured = []
+    original = safer.html.process_final_dictionary
+
+    def capture(data):
+        captured.append(copy.deepcopy(data))
+        return original(data)
+
+    safer.html.process_final_dictionary = capture
+    try:
+        for tree in trees:
+            process_company_snapshot(tree)
+    finally:
+        safer.html.process_final_dictionary = original
+    return captured
+
+
+def percentile(sorted_values, percent):
+    index = min(len(sorted_values) - 1, int(round(percent / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(func, make_args, iterations):
+    """
+    Times `func` on its own.
+
+    :param func: Function to benchmark, it takes one argument.
+    :param make_args: Function that returns a fresh list of arguments, one call is made per argument.
+    :param iterations: Number of times the list of arguments is run through.
+    :return: Dictionary of results.
+    """
+    durations = []
+    for _ in range(iterations):
+        args = make_args()
+        for arg in args:
+            start = time.perf_counter_ns()
+            func(arg)
+            durations.append(time.perf_counter_ns() - start)
+    durations.sort()
+
+    # Memory is measured in a separate pass, tracing slows everything down
+    peak = 0
+    tracemalloc.start()
+    try:
+        for arg in make_args():
+            tracemalloc.reset_peak()
+            func(arg)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "calls": len(durations),
+        "ops_per_sec": round(len(durations) / (sum(durations) / 1e9), 1),
+        "p50_us": round(percentile(durations, 50) / 1e3, 1),
+        "p99_us": round(percentile(durations, 99) / 1e3, 1),
+        "peak_memory_kib": round(peak / 1024, 1),
+    }
+
+
+def run(iterations=50):
+    snapshots, searches = load_fixtures()
+    snapshot_trees = [parse_html_to_tree(page) for page in snapshots]
+    search_trees = [parse_html_to_tree(page) for page in searches]
+    unprocessed = capture_unprocessed_dictionaries(snapshot_trees)
+    processed = [process_final_dictionary(copy.deepcopy(data)) for data in unprocessed]
+
+    # The fixtures are read as latin-1, encoding them back gives the bytes of the pages
+    pages = [page.encode("latin-1") for page in snapshots + searches]
+
+    stages = {
+        "parse_html_to_tree": (parse_html_to_tree, lambda: snapshots + searches),
+        "parse_page": (lambda page: parse_page(page, "latin-1"), lambda: pages),
+        "process_search_result_html": (process_search_result_html, lambda: search_trees),
+        "process_company_snapshot": (process_company_snapshot, lambda: snapshot_trees),
+        "process_final_dictionary": (process_final_dictionary, lambda: copy.deepcopy(unprocessed)),
+        "Company.__init__": (Company, lambda: copy.deepcopy(processed)),
+    }
+    return {
+        "python": platform.python_version(),
+        "fixtures": {"snapshots": len(snapshots), "searches": len(searches)},
+        "stages": {name: measure(func, make_args, iterations) for name, (func, make_args) in stages.items()},
+    }
+
+
+def print_results(results, baseline=None):
+    columns = ("ops_per_sec", "p50_us", "p99_us", "peak_memory_kib")
+    print("{:<28}".format("stage") + "".join("{:>18}".format(c) for c in columns))
+    for name, stage in results["stages"].items():
+        cells = []
+        for column in columns:
+            cell = "{}".format(stage[column])
+            if baseline is not None and name in baseline["stages"] and baseline["stages"][name][column]:
+                change = stage[column] / baseline["stages"][name][column] - 1
+                cell += " ({:+.0%})".format(change)
+            cells.append("{:>18}".format(cell))
+        print("{:<28}".format(name) + "".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=50, help="Times every stage runs through the fixtures")
+    parser.add_argument("--save", type=Path, help="Save the results as a baseline JSON file")
+    parser.add_argument("--compare", type=Path, help="Compare the results against a baseline JSON file")
+    args = parser.parse_args()
+
+    results = run(iterations=args.iterations)
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+    print_results(results, baseline)
+    if args.save:
+        args.save.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Micro-benchmark of the text normalization in process_extracted_text, per Company Snapshot. The text extracted from
+the fixtures is captured once, then run through the current implementation and the original one, which used an
+uncompiled re.sub per string and a substring check for "none".
+
+    python -m benchmarks.text --iterations 2000
+"""
+import argparse
+import re
+import time
+import safer.html
+from safer.crawler import parse_html_to_tree
+from safer.html import process_company_snapshot
+from benchmarks.run import load_fixtures
+
+
+def legacy_process_extracted_text(extracted_data):
+    """
+    process_extracted_text as it was before the normalization was reworked, kept as the reference to measure against.
+    """
+    if isinstance(extracted_data, list):
+        if len(extracted_data) > 1:
+            return " ".join([re.sub("[\n\t\r\xa0]+", "", x.strip()) for x in extracted_data]).strip()
+        if len(extracted_data) == 0:
+            return None
+        if "none" in extracted_data[0].lower():
+            return None
+        return extracted_data[0].strip()
+    if isinstance(extracted_data, str):
+        if "none" in extracted_data.lower() or extracted_data.lower() == "":
+            return None
+        return extracted_data.strip()
+    raise ValueError("Unrecognized parsing result.")
+
+
+def capture_extracted_text(trees):
+    """
+    :return: List with the arguments of every process_extracted_text call made while parsing each tree.
+    """
+    captured = []
+    original = safer.html.process_extracted_text
+
+    def capture(extracted_data):
+        captured[-1].append(extracted_data)
+        return original(extracted_data)
+
+    safer.html.process_extracted_text = capture
+    try:
+        for tree in trees:
+            captured.append([])
+            process_company_snapshot(tree)
+    finally:
+        safer.html.process_extracted_text = original
+    return captured
+
+
+def time_per_snapshot(func, snapshots, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for arguments in snapshots:
+            for extracted_data in arguments:
+                func(extracted_data)
+    return (time.perf_counter() - start) / (iterations * len(snapshots))
+
+
+def run(iterations):
+    pages, _ = load_fixtures()
+    snapshots = capture_extracted_text([parse_html_to_tree(page) for page in pages])
+    calls = [extracted_data for arguments in snapshots for extracted_data in arguments]
+    changed = sum(
+        legacy_process_extracted_text(extracted_data) != safer.html.process_extracted_text(extracted_data)
+        for extracted_data in calls
+    )
+    return {
+        "calls_per_snapshot": round(len(calls) / len(snapshots), 1),
+        "legacy_us_per_snapshot": round(
+            time_per_snapshot(legacy_process_extracted_text, snapshots, iterations) * 1e6, 2
+        ),
+        "current_us_per_snapshot": round(
+            time_per_snapshot(safer.html.process_extracted_text, snapshots, iterations) * 1e6, 2
+        ),
+        "results_changed": changed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000, help="Times the captured text is run through")
+    args = parser.parse_args()
+    for name, value in run(args.iterations).items():
+        print("{:<28}{:>12}".format(name, value))
+
+
+if __name__ == "__main__":
+    main()
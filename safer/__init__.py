@@ -1 +1,2 @@
 from .search import CompanySnapshot
+from .async_search import AsyncCompanySnapshot
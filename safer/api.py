@@ -1,54 +1,524 @@
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 from requests import Session
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+from requests.exceptions import ConnectionError as RequestsConnectionError, Timeout
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+from safer.cache import (
+    CachedResponse,
+    cache_key,
+    conditional_headers,
+    dump_validators,
+    load_company_record,
+    validator_headers,
+    validators_key,
+)
+from safer import instrumentation
+from safer.exceptions import SAFERUnreachableException
+from safer.singleflight import SingleFlight
 
 SAFER_KEYWORD_URL = "https://safer.fmcsa.dot.gov/keywordx.asp"
 SAFER_QUERY_URL = "https://safer.fmcsa.dot.gov/query.asp"
 
-sess = Session()
-sess.headers.update(
-    {
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-        "Accept-Encoding": "gzip, deflate",
-        "Accept-Language": "en-US,en;q=0.8,ru;q=0.6",
-        "Cache-Control": "max-age=0",
-        "Connection": "keep-alive",
-        "Host": "safer.fmcsa.dot.gov",
-        "Upgrade-Insecure-Requests": "1",
-        "User-Agent":
-            "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.14; rv:68.0) Gecko/20100101 Firefox/68.0",
+HEADERS = {
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    # Every encoding urllib3 can decode, br and zstd are included when brotli and zstandard are installed
+    "Accept-Encoding": ACCEPT_ENCODING,
+    "Accept-Language": "en-US,en;q=0.8,ru;q=0.6",
+    "Cache-Control": "max-age=0",
+    "Connection": "keep-alive",
+    "Host": "safer.fmcsa.dot.gov",
+    "Upgrade-Insecure-Requests": "1",
+    "User-Agent":
+        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.14; rv:68.0) Gecko/20100101 Firefox/68.0",
+}
+
+# Cache modes, either the raw responses are cached or, for Company Snapshots, the parsed records.
+CACHE_RESPONSES = "responses"
+CACHE_COMPANIES = "companies"
+
+# Errors after which an expired cache entry is served instead, when there is one. Without a transport policy the
+# connection errors and timeouts of requests aren't wrapped in SAFERUnreachableException.
+UNREACHABLE_ERRORS = (SAFERUnreachableException, RequestsConnectionError, Timeout)
+
+# Threads of a client that revalidate expired entries served under stale_while_revalidate
+REVALIDATION_WORKERS = 4
+
+
+def search_params(query):
+    """
+    Builds the query string parameters for a keyword search.
+
+    :param query: Company name to search for.
+    :return: Dictionary of query string parameters.
+    """
+    return {"searchstring": "*{}*".format(query.upper()), "SEARCHTYPE": ""}
+
+
+def snapshot_form(query_param, query_string):
+    """
+    Builds the form data for a Company Snapshot query.
+
+    :param query_param: Either "USDOT" or "MC_MX".
+    :param query_string: The number to look up.
+    :return: Dictionary of form data.
+    """
+    return {
+        "searchType": "ANY",
+        "query_type": "queryCarrierSnapshot",
+        "query_param": query_param,
+        "query_string": query_string,
     }
-)
 
 
-def api_call_search(query):
-    r = sess.get(
-        url=SAFER_KEYWORD_URL,
-        params={"searchstring": "*{}*".format(query.upper()), "SEARCHTYPE": ""},
-    )
+class SaferClient:
+    """
+    Client that owns the session requests to SAFER are made with, along with its connection pool, timeouts and
+    retries, and the cache and transport policy the requests go through.
+
+    Every CompanySnapshot method takes a `client`, so each worker can have a client sized to its concurrency.
+    Without one the module's default client is used.
+
+    Concurrent identical lookups made through the same client are coalesced by `flights`: threads that ask for a
+    Company or a search that's already being fetched wait for that fetch instead of making their own.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        *,
+        pool_connections=DEFAULT_POOLSIZE,
+        pool_maxsize=DEFAULT_POOLSIZE,
+        connect_timeout=10.0,
+        read_timeout=60.0,
+        keep_alive=True,
+        retries=0,
+        cache=None,
+        cache_mode=CACHE_RESPONSES,
+        stale_while_revalidate=None,
+        policy=None,
+        local_index=None,
+        docket_index=None,
+        session=None,
+    ):
+        """
+        :param pool_connections: Number of connection pools to keep, one per host.
+        :param pool_maxsize: Number of connections to keep alive in each pool.
+        :param connect_timeout: Seconds to wait for a connection to SAFER, None to wait forever.
+        :param read_timeout: Seconds to wait between bytes of the response, None to wait forever.
+        :param keep_alive: Whether connections are kept alive between requests.
+        :param retries: Number of times a request that failed to connect, failed to read or got a 502, 503 or 504 is
+            retried by urllib3.
+        :param cache: Cache results are stored in, see set_cache.
+        :param cache_mode: CACHE_RESPONSES or CACHE_COMPANIES, see set_cache.
+        :param stale_while_revalidate: Seconds an expired entry is served for while it's revalidated, see set_cache.
+        :param policy: Transport policy requests are made under, see set_transport_policy.
+        :param local_index: safer.index.LocalIndex that every fetched Company and SearchResult is added to, see
+            set_local_index.
+        :param docket_index: safer.index.DocketIndex that every fetched Company is added to, see set_docket_index.
+        :param session: Existing requests.Session to use as is, instead of creating one with the settings above.
+        """
+        # The adapters of a session given by the caller are theirs, only the ones of a session created here are
+        # mounted or resized
+        self.__owns_session = session is None
+        if session is None:
+            session = Session()
+            session.headers.update(HEADERS)
+            if not keep_alive:
+                session.headers["Connection"] = "close"
+        self.session = session
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        if self.__owns_session and (
+            retries or pool_connections != DEFAULT_POOLSIZE or pool_maxsize != DEFAULT_POOLSIZE
+        ):
+            self.__mount_adapter()
+
+        self.cache = None
+        self.cache_mode = CACHE_RESPONSES
+        self.stale_while_revalidate = None
+        self.set_cache(cache, cache_mode, stale_while_revalidate)
+        self.__revalidating = set()
+        self.__revalidations = None
+        self.__revalidations_lock = threading.Lock()
+        self.policy = policy
+        self.local_index = local_index
+        self.docket_index = docket_index
+        self.flights = SingleFlight()
+
+    def __mount_adapter(self):
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            max_retries=Retry(
+                total=self.retries,
+                backoff_factor=0.5,
+                status_forcelist=(502, 503, 504),
+                # SAFER's snapshot queries are POST requests but don't change anything, so they are safe to retry
+                allowed_methods=frozenset(["GET", "POST"]),
+                raise_on_status=False,
+            )
+            if self.retries
+            else 0,
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def ensure_pool_size(self, maxsize):
+        """
+        Grows the connection pool so that `maxsize` threads can keep a connection to SAFER alive at the same time,
+        instead of discarding connections when the pool is full.
+
+        The adapters of a session passed to the client are left as they are, a warning is issued instead.
+
+        :param maxsize: Number of connections the pool should keep.
+        """
+        if maxsize <= self.pool_maxsize:
+            return
+        if not self.__owns_session:
+            warnings.warn(
+                "The connection pool of a session passed to SaferClient isn't resized for {} threads, connections "
+                "beyond its size are discarded after every request".format(maxsize),
+                stacklevel=3,
+            )
+            return
+        self.pool_maxsize = maxsize
+        self.__mount_adapter()
+
+    def set_cache(self, cache, mode=CACHE_RESPONSES, stale_while_revalidate=None):
+        """
+        Sets the cache that results from SAFER are stored in, such as a safer.cache.MemoryCache or
+        safer.cache.SQLiteCache. Passing None turns caching off.
+
+        With mode CACHE_COMPANIES the Company Snapshots are cached as parsed records, so a hit skips the HTML parsing
+        altogether, search results are still cached as responses.
+
+        With stale_while_revalidate, an entry that expired less than that many seconds ago is served right away
+        while it's revalidated in the background, instead of waiting on SAFER. float("inf") serves expired entries
+        however old they are.
+
+        :param cache: Cache object or None.
+        :param mode: CACHE_RESPONSES or CACHE_COMPANIES.
+        :param stale_while_revalidate: Seconds an expired entry is served for while it's revalidated, None to wait
+            for SAFER once an entry has expired.
+        """
+        if mode not in (CACHE_RESPONSES, CACHE_COMPANIES):
+            raise ValueError("'mode' must be either CACHE_RESPONSES or CACHE_COMPANIES")
+        if stale_while_revalidate is not None and stale_while_revalidate < 0:
+            raise ValueError("'stale_while_revalidate' must be at least 0")
+        self.cache = cache
+        self.cache_mode = mode
+        self.stale_while_revalidate = stale_while_revalidate
+
+    def company_cache(self):
+        """
+        :return: The cache parsed Company Snapshots are stored in, or None if they are not cached.
+        """
+        return self.cache if self.cache_mode == CACHE_COMPANIES else None
+
+    def index_company(self, company):
+        """
+        Adds a Company to the local and docket indexes, if the client has them.
+
+        :param company: Company
+        :return: The Company.
+        """
+        if self.local_index is not None:
+            self.local_index.add_company(company)
+        if self.docket_index is not None:
+            self.docket_index.add_company(company)
+        return company
+
+    def stale_entry(self, key, decode=None):
+        """
+        Gets an expired entry that can be served while it's revalidated, under the stale_while_revalidate setting.
+
+        :param key: Key of the entry.
+        :param decode: Optional function applied to the cached value, see BaseCache.get_stale_entry.
+        :return: (value, stored_at) tuple, or None if there is no such entry or stale_while_revalidate is off.
+        """
+        if self.cache is None or self.stale_while_revalidate is None:
+            return None
+        return self.cache.get_stale_entry(key, decode=decode, max_stale=self.stale_while_revalidate)
+
+    def revalidate_in_background(self, key, refresh):
+        """
+        Runs the refresh of an expired entry in a background thread, unless one is already running for the key. A
+        refresh that fails leaves the entry as it is, it's tried again the next time the entry is served.
+
+        :param key: Key of the entry.
+        :param refresh: Function without arguments that requests the entry again and stores it.
+        """
+        with self.__revalidations_lock:
+            if key in self.__revalidating:
+                return
+            self.__revalidating.add(key)
+            if self.__revalidations is None:
+                self.__revalidations = ThreadPoolExecutor(
+                    max_workers=REVALIDATION_WORKERS, thread_name_prefix="safer-revalidate"
+                )
+            revalidations = self.__revalidations
+
+        def run():
+            try:
+                refresh()
+            except Exception:  # pylint: disable=broad-except
+                # The stale entry stays in the cache, SAFER being unreachable is what it's served for
+                pass
+            finally:
+                with self.__revalidations_lock:
+                    self.__revalidating.discard(key)
+
+        revalidations.submit(run)
+
+    def send(self, call, stream=False):
+        """
+        Makes a request under the transport policy, if there is one.
+
+        :param call: Function without arguments that makes the request.
+        :param stream: Whether the body of the response is left to be streamed, it isn't counted as received then.
+        :return: requests.Response
+        """
+        policy = self.policy
+        if not instrumentation.subscribers:
+            return call() if policy is None else policy.execute(call)
+
+        instrumentation.emit(instrumentation.REQUEST_START, 1)
+        start = time.perf_counter()
+        try:
+            r = call() if policy is None else policy.execute(call)
+        except Exception as e:
+            instrumentation.emit(
+                instrumentation.REQUEST_END, time.perf_counter() - start, {"error": type(e).__name__}
+            )
+            raise
+        instrumentation.emit(
+            instrumentation.REQUEST_END,
+            time.perf_counter() - start,
+            {"status": instrumentation.status_class(r.status_code)},
+        )
+        if not stream:
+            instrumentation.emit(instrumentation.BYTES_RECEIVED, len(r.content))
+        return r
+
+    def cached_call(self, query_type, identifier, call, conditional=False, revalidate=False):
+        """
+        Serves a query from the response cache if it holds a fresh entry for it, otherwise makes the request and
+        caches the response if it was successful. If SAFER is unreachable or answers with a server error, an expired
+        entry is served instead when there is one. Under stale_while_revalidate, an expired entry is served right away
+        and revalidated in the background.
+
+        The ETag and Last-Modified validators of cached responses are kept, an expired entry is revalidated with a
+        conditional request and served from the cache if SAFER answers 304 Not Modified.
+
+        :param query_type: Type of the query, one of "search", "usdot" or "mc_mx".
+        :param identifier: Name, USDOT Number or MC/MX Number that is queried.
+        :param call: Function that makes the request, it takes a dictionary of headers to add to the request.
+        :param conditional: Whether the request may be made conditional on the parsed record in the cache when
+            Company Snapshots are cached as records, the caller then handles the 304 response.
+        :param revalidate: Whether a fresh entry is revalidated with SAFER instead of served, the request is then
+            always made, conditional on what's in the cache in both cache modes.
+        :return: requests.Response or CachedResponse.
+        """
+        cache = self.cache
+        if cache is None:
+            return self.send(lambda: call({}))
+
+        if query_type != "search" and self.cache_mode == CACHE_COMPANIES:
+            # The record is stored by the caller together with the validators of its page
+            headers = {}
+            if conditional or revalidate:
+                value = cache.peek(cache_key("company:" + query_type, identifier))
+                record = load_company_record(value) if value is not None else None
+                if record is not None:
+                    headers = validator_headers(record.validators)
+            return self.send(lambda: call(headers))
+
+        key = cache_key(query_type, identifier)
+        if revalidate:
+            return self.__request(cache, key, call)
+        entry = cache.get_entry(key)
+        if entry is not None:
+            return CachedResponse(entry[0], stored_at=entry[1])
+        entry = self.stale_entry(key)
+        if entry is not None:
+            self.revalidate_in_background(key, lambda: self.__request(cache, key, call))
+            return CachedResponse(entry[0], stale=True, stored_at=entry[1])
+        return self.__request(cache, key, call)
+
+    def __request(self, cache, key, call):
+        headers = self.__conditional_headers(key) if cache.peek(key) is not None else {}
+        try:
+            r = self.send(lambda: call(headers))
+        except UNREACHABLE_ERRORS:
+            stale = self.__stale_response(cache, key)
+            if stale is None:
+                raise
+            return stale
+        if r.status_code > 499:
+            # An error from SAFER is answered with the expired entry too
+            stale = self.__stale_response(cache, key)
+            if stale is not None:
+                return stale
+        if r.status_code == 304:
+            text = cache.revalidate(key)
+            if text is not None:
+                return CachedResponse(text, stored_at=time.time())
+            # The entry was evicted since the request was made
+            r = self.send(lambda: call({}))
+        if r.status_code < 400:
+            cache.set(key, r.text)
+            self.__store_validators(key, r)
+        return r
+
+    @staticmethod
+    def __stale_response(cache, key):
+        entry = cache.get_stale_entry(key)
+        return CachedResponse(entry[0], stale=True, stored_at=entry[1]) if entry is not None else None
+
+    def __conditional_headers(self, key):
+        value = self.cache.peek(validators_key(key))
+        return conditional_headers(value) if value is not None else {}
+
+    def __store_validators(self, key, r):
+        value = dump_validators(r.headers)
+        if value is not None:
+            self.cache.set(validators_key(key), value)
+        else:
+            self.cache.delete(validators_key(key))
+
+    def search(self, query):
+        return self.cached_call(
+            "search",
+            query,
+            lambda headers: self.session.get(
+                url=SAFER_KEYWORD_URL, params=search_params(query), headers=headers, timeout=self.timeout
+            ),
+        )
+
+    def search_stream(self, query):
+        """
+        Makes a keyword search without reading the body, so it can be parsed while it's received with
+        iter_content(). A fresh response in the cache is served from it, but streamed responses are not stored since
+        the whole body is never held in memory.
+
+        :param query: Company name to search for.
+        :return: requests.Response or CachedResponse.
+        """
+        cache = self.cache
+        if cache is not None:
+            text = cache.get(cache_key("search", query))
+            if text is not None:
+                return CachedResponse(text)
+        return self.send(
+            lambda: self.session.get(
+                url=SAFER_KEYWORD_URL, params=search_params(query), timeout=self.timeout, stream=True
+            ),
+            stream=True,
+        )
+
+    def get_usdot(self, usdot, conditional=False, revalidate=False):
+        return self.cached_call(
+            "usdot",
+            usdot,
+            lambda headers: self.session.post(
+                url=SAFER_QUERY_URL, data=snapshot_form("USDOT", usdot), headers=headers, timeout=self.timeout
+            ),
+            conditional=conditional,
+            revalidate=revalidate,
+        )
+
+    def get_mcmx(self, mcmx, conditional=False, revalidate=False):
+        return self.cached_call(
+            "mc_mx",
+            mcmx,
+            lambda headers: self.session.post(
+                url=SAFER_QUERY_URL, data=snapshot_form("MC_MX", mcmx), headers=headers, timeout=self.timeout
+            ),
+            conditional=conditional,
+            revalidate=revalidate,
+        )
+
+    def close(self):
+        with self.__revalidations_lock:
+            revalidations, self.__revalidations = self.__revalidations, None
+        if revalidations is not None:
+            revalidations.shutdown(wait=True)
+        self.session.close()
+
+
+# Client used when none is given, it keeps the behavior of waiting on SAFER for as long as it takes. It creates the
+# module session itself, so its pool is grown for get_many like the pool of any other client.
+default_client = SaferClient(connect_timeout=None, read_timeout=None)
+sess = default_client.session
+
+
+def get_client(client=None):
+    """
+    :param client: SaferClient or None.
+    :return: The client given, or the default client if it's None.
+    """
+    return client if client is not None else default_client
+
+
+def set_transport_policy(policy):
+    """
+    Sets the policy every request to SAFER made with the default client is made under, such as a
+    safer.policy.TransportPolicy that rate limits, retries and stops requests while SAFER is down. Passing None makes
+    requests directly.
+
+    :param policy: Policy object or None.
+    """
+    default_client.policy = policy
+
+
+def set_cache(cache, mode=CACHE_RESPONSES, stale_while_revalidate=None):
+    """
+    Sets the cache of the default client, see SaferClient.set_cache.
+    """
+    default_client.set_cache(cache, mode, stale_while_revalidate)
+
+
+def set_local_index(index):
+    """
+    Sets the safer.index.LocalIndex of the default client, every Company and SearchResult fetched with it is added to
+    the index and CompanySnapshot.search(..., source="local") searches it. Passing None turns indexing off.
+
+    :param index: LocalIndex or None.
+    """
+    default_client.local_index = index
+
+
+def set_docket_index(index):
+    """
+    Sets the safer.index.DocketIndex of the default client, every Company fetched with it is added to the index and
+    CompanySnapshot.get_by_mc_mx_number resolves MC/MX Numbers through it before going to SAFER. Passing None turns
+    it off.
+
+    :param index: DocketIndex or None.
+    """
+    default_client.docket_index = index
+
+
+def api_call_search(query, client=None):
+    r = get_client(client).search(query)
 
     return r
 
 
-def api_call_get_usdot(usdot):
-    r = sess.post(
-        url=SAFER_QUERY_URL,
-        data={
-            "searchType": "ANY",
-            "query_type": "queryCarrierSnapshot",
-            "query_param": "USDOT",
-            "query_string": usdot,
-        },
-    )
+def api_call_search_stream(query, client=None):
+    return get_client(client).search_stream(query)
+
+
+def api_call_get_usdot(usdot, client=None, conditional=False, revalidate=False):
+    r = get_client(client).get_usdot(usdot, conditional=conditional, revalidate=revalidate)
     return r
 
 
-def api_call_get_mcmx(mcmx):
-    r = sess.post(
-        url=SAFER_QUERY_URL,
-        data={
-            "searchType": "ANY",
-            "query_type": "queryCarrierSnapshot",
-            "query_param": "MC_MX",
-            "query_string": mcmx,
-        },
-    )
+def api_call_get_mcmx(mcmx, client=None, conditional=False, revalidate=False):
+    r = get_client(client).get_mcmx(mcmx, conditional=conditional, revalidate=revalidate)
     return r
@@ -0,0 +1,383 @@
+"""
+Append-only archive of the raw pages fetched from SAFER, so they can be parsed again without requesting them again.
+
+The pages are compressed one by one and appended to segment files, an index stored in SQLite maps every page to its
+(query type, identifier, fetch time) and its offset in its segment. Pages are read through memory maps of the
+segments, and the archive can stand in for SAFER through ArchiveAdapter.
+"""
+import io
+import mmap
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs, urlparse
+from requests.adapters import BaseAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from safer.cache import cache_key
+from safer.exceptions import CompanySnapshotNotFoundException
+from safer.pipeline import parse_snapshot_page
+from safer.results import Company
+
+# Query types of the pages, named like the cache keys
+QUERY_TYPES = {"USDOT": "usdot", "MC_MX": "mc_mx"}
+SEARCH = "search"
+
+ArchiveEntry = namedtuple(
+    "ArchiveEntry", ["query_type", "identifier", "fetched_at", "encoding", "segment", "offset", "length"]
+)
+ArchivedPage = namedtuple("ArchivedPage", ["query_type", "identifier", "fetched_at", "encoding", "content"])
+
+
+def _identifier(query_type, identifier):
+    # The identifier as it's stored in the index, cache_key already normalizes it
+    return cache_key(query_type, identifier).split(":", 1)[1]
+
+
+class _SegmentMaps:
+    """
+    Memory maps of the segments of an archive, a segment is mapped again once it has grown past its map.
+
+    The lock is only held to find or map the segment, pages are decompressed outside of it so concurrent reads don't
+    wait on each other. A map that's replaced while other threads still read from it is kept open until they are done.
+    """
+
+    def __init__(self):
+        self.__maps = {}
+        self.__replaced = []
+        self.__lock = threading.Lock()
+
+    def read(self, path, offset, length):
+        """
+        :return: Decompressed bytes of the page at the offset of the segment.
+        """
+        with self.__lock:
+            mapped = self.__maps.get(path)
+            if mapped is None or len(mapped) < offset + length:
+                if mapped is not None:
+                    self.__replaced.append(mapped)
+                    self.__close_replaced()
+                with open(path, "rb") as f:
+                    mapped = self.__maps[path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # The view is taken under the lock, as long as it's held the map can't be closed
+            with memoryview(mapped) as whole:
+                view = whole[offset:offset + length]
+        # Decompressed straight from the map, the compressed bytes are never copied
+        try:
+            return zlib.decompress(view)
+        finally:
+            view.release()
+
+    def __close_replaced(self):
+        remaining = []
+        for mapped in self.__replaced:
+            try:
+                mapped.close()
+            except BufferError:
+                # Another thread is still reading from it
+                remaining.append(mapped)
+        self.__replaced = remaining
+
+    def close(self):
+        with self.__lock:
+            self.__replaced.extend(self.__maps.values())
+            self.__maps = {}
+            self.__close_replaced()
+
+
+class PageArchive:
+    """
+    Append-only archive of pages stored in a directory, as segment files of compressed pages and an index.
+
+    Every fetch of a page is kept, get returns the latest one unless a fetch time is given. Use it as a context
+    manager, or call close() when done.
+    """
+
+    def __init__(self, path, segment_size=1024 ** 3, compression_level=6):
+        """
+        :param path: Directory of the archive, it is created if it does not exist.
+        :param segment_size: Bytes after which a new segment is started.
+        :param compression_level: zlib compression level of the pages, from 1 to 9.
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.segment_size = segment_size
+        self.compression_level = compression_level
+        self.__lock = threading.Lock()
+        self.__maps = _SegmentMaps()
+        self.__connection = sqlite3.connect(os.path.join(path, "index.sqlite"), check_same_thread=False)
+        with self.__connection:
+            # With WAL, NORMAL only skips the sync of every commit, an appended page survives the process crashing
+            self.__connection.execute("PRAGMA journal_mode=WAL")
+            self.__connection.execute("PRAGMA synchronous=NORMAL")
+            self.__connection.execute(
+                "CREATE TABLE IF NOT EXISTS pages (query_type TEXT, identifier TEXT, fetched_at REAL, encoding TEXT, "
+                "segment INTEGER, offset INTEGER, length INTEGER)"
+            )
+            self.__connection.execute(
+                "CREATE INDEX IF NOT EXISTS pages_key ON pages (query_type, identifier, fetched_at)"
+            )
+        row = self.__connection.execute("SELECT MAX(segment) FROM pages").fetchone()
+        self.__segment = row[0] if row[0] is not None else 0
+        self.__writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, "segment-{:05d}.dat".format(segment))
+
+    def append(  # pylint: disable=too-many-arguments
+        self, query_type, identifier, content, fetched_at=None, encoding=None
+    ):
+        """
+        Appends a page to the archive.
+
+        :param query_type: "usdot", "mc_mx" or "search".
+        :param identifier: USDOT Number, MC/MX Number or searched name.
+        :param content: Bytes of the page.
+        :param fetched_at: Time in seconds since the epoch the page was fetched, now if None.
+        :param encoding: Encoding of the page, such as response.encoding.
+        :return: ArchiveEntry of the page.
+        """
+        compressed = zlib.compress(content, self.compression_level)
+        fetched_at = fetched_at if fetched_at is not None else time.time()
+        with self.__lock:
+            if self.__writer is None or self.__writer.tell() + len(compressed) > self.segment_size > 0:
+                self.__open_segment(self.__writer is not None)
+            offset = self.__writer.tell()
+            self.__writer.write(compressed)
+            # The page is in its segment before the index points to it, a crash in between leaves unindexed bytes
+            self.__writer.flush()
+            entry = ArchiveEntry(
+                query_type, _identifier(query_type, identifier), fetched_at, encoding, self.__segment, offset,
+                len(compressed),
+            )
+            with self.__connection:
+                self.__connection.execute("INSERT INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)", entry)
+        return entry
+
+    def __open_segment(self, full):
+        if self.__writer is not None:
+            self.__writer.close()
+        if full or (
+            os.path.exists(self.segment_path(self.__segment))
+            and os.path.getsize(self.segment_path(self.__segment)) >= self.segment_size > 0
+        ):
+            self.__segment += 1
+        self.__writer = open(self.segment_path(self.__segment), "ab")  # pylint: disable=consider-using-with
+        # Append mode starts at the end of the file, but tell() only knows once something is written
+        self.__writer.seek(0, os.SEEK_END)
+
+    def read(self, entry):
+        """
+        :param entry: ArchiveEntry
+        :return: ArchivedPage with the bytes of the page.
+        """
+        content = self.__maps.read(self.segment_path(entry.segment), entry.offset, entry.length)
+        return ArchivedPage(entry.query_type, entry.identifier, entry.fetched_at, entry.encoding, content)
+
+    def entry(self, query_type, identifier, fetched_at=None):
+        """
+        :param query_type: "usdot", "mc_mx" or "search".
+        :param identifier: USDOT Number, MC/MX Number or searched name.
+        :param fetched_at: Time in seconds since the epoch, the latest fetch at or before it is returned. None for
+            the latest fetch.
+        :return: ArchiveEntry, or None if the page isn't in the archive.
+        """
+        query = "SELECT * FROM pages WHERE query_type = ? AND identifier = ?"
+        params = [query_type, _identifier(query_type, identifier)]
+        if fetched_at is not None:
+            query += " AND fetched_at <= ?"
+            params.append(fetched_at)
+        with self.__lock:
+            row = self.__connection.execute(query + " ORDER BY fetched_at DESC LIMIT 1", params).fetchone()
+        return ArchiveEntry(*row) if row is not None else None
+
+    def get(self, query_type, identifier, fetched_at=None):
+        """
+        :return: ArchivedPage, or None if the page isn't in the archive, see entry for the parameters.
+        """
+        entry = self.entry(query_type, identifier, fetched_at)
+        return self.read(entry) if entry is not None else None
+
+    def entries(self, query_type=None, latest_only=True):
+        """
+        :param query_type: Query type of the entries, None for all of them.
+        :param latest_only: Whether only the latest fetch of every page is returned.
+        :return: List of ArchiveEntries, ordered by their position in the segments so they are read sequentially.
+        """
+        query = "SELECT * FROM pages"
+        if latest_only:
+            # SQLite returns the other columns of the row with the maximum
+            query = (
+                "SELECT query_type, identifier, MAX(fetched_at), encoding, segment, offset, length FROM pages "
+                "GROUP BY query_type, identifier"
+            )
+        params = []
+        if query_type is not None:
+            query = "SELECT * FROM ({}) WHERE query_type = ?".format(query)
+            params.append(query_type)
+        query = "SELECT * FROM ({}) ORDER BY segment, offset".format(query)
+        with self.__lock:
+            return [ArchiveEntry(*row) for row in self.__connection.execute(query, params)]
+
+    def iter_pages(self, query_type=None, latest_only=True):
+        """
+        :return: Generator of ArchivedPages, see entries for the parameters.
+        """
+        for entry in self.entries(query_type, latest_only):
+            yield self.read(entry)
+
+    def __len__(self):
+        with self.__lock:
+            return self.__connection.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+
+    def close(self):
+        with self.__lock:
+            if self.__writer is not None:
+                self.__writer.close()
+                self.__writer = None
+            self.__maps.close()
+            self.__connection.close()
+
+
+# Memory maps of the reprocess workers, each process maps the segments once
+_worker_maps = _SegmentMaps()
+
+
+def _parse_archived(path, offset, length, encoding):
+    try:
+        return parse_snapshot_page(_worker_maps.read(path, offset, length), encoding)
+    except Exception as e:  # pylint: disable=broad-except
+        # Sent back as the result of the page, one page the parser fails on doesn't stop the others
+        return e
+
+
+def reprocess(archive, workers=None, latest_only=True, chunksize=64):
+    """
+    Parses every Company Snapshot in the archive again, such as after the parser was fixed, in a pool of processes.
+    Only the offsets of the pages are sent to the processes, they read the pages from their own memory maps of the
+    segments.
+
+    :param archive: PageArchive
+    :param workers: Number of processes, the number of CPUs by default.
+    :param latest_only: Whether only the latest fetch of every Company Snapshot is parsed.
+    :param chunksize: Number of pages sent to a process at once.
+    :return: Generator of (ArchiveEntry, Company or Exception) tuples, in the order of the archive. The exception is
+        the one raised while parsing the page.
+    """
+    entries = [e for e in archive.entries(latest_only=latest_only) if e.query_type != SEARCH]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(
+            _parse_archived,
+            [archive.segment_path(e.segment) for e in entries],
+            [e.offset for e in entries],
+            [e.length for e in entries],
+            [e.encoding for e in entries],
+            chunksize=chunksize,
+        )
+        for entry, parsed in zip(entries, results):
+            if isinstance(parsed, Exception):
+                yield entry, parsed
+                continue
+            if parsed is None:
+                yield entry, CompanySnapshotNotFoundException(
+                    "No records for {} {} in the archive.".format(entry.query_type, entry.identifier)
+                )
+                continue
+            data, page_hash = parsed
+            yield entry, Company(data=data, content_hash=page_hash, fetched_at=entry.fetched_at)
+
+
+class ArchiveAdapter(BaseAdapter):
+    """
+    Transport adapter that answers the requests of a SaferClient from a PageArchive. Mount it on the session of the
+    client to replay the archive:
+
+        client = SaferClient()
+        client.session.mount("https://safer.fmcsa.dot.gov/", ArchiveAdapter(archive))
+
+    A page that isn't in the archive is answered with 404, or with a fallback adapter is requested from SAFER and
+    appended to the archive when it's successful, so the archive fills up as it's used.
+    """
+
+    def __init__(self, archive, fallback=None):
+        """
+        :param archive: PageArchive
+        :param fallback: Adapter that makes the requests for pages missing from the archive, such as an HTTPAdapter.
+        """
+        super().__init__()
+        self.archive = archive
+        self.fallback = fallback
+
+    @staticmethod
+    def query_of(request):
+        """
+        :param request: requests.PreparedRequest made by a SaferClient.
+        :return: (query type, identifier) tuple, or None if it's not a SAFER query.
+        """
+        if request.method == "GET":
+            searchstring = parse_qs(urlparse(request.url).query).get("searchstring")
+            return (SEARCH, searchstring[0].strip("*")) if searchstring else None
+        body = request.body.decode("utf-8") if isinstance(request.body, bytes) else request.body or ""
+        form = parse_qs(body)
+        query_type = QUERY_TYPES.get(form.get("query_param", [""])[0])
+        if query_type is None or "query_string" not in form:
+            return None
+        return query_type, form["query_string"][0]
+
+    def send(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None
+    ):
+        query = self.query_of(request)
+        page = self.archive.get(*query) if query is not None else None
+        if page is not None:
+            return self.build_response(request, page)
+        if self.fallback is None:
+            return self.build_response(request, None)
+
+        r = self.fallback.send(request, stream=stream, timeout=timeout, verify=verify, cert=cert, proxies=proxies)
+        # Streamed responses are left to the caller, reading them here would defeat the streaming
+        if query is not None and r.status_code == 200 and not stream:
+            self.archive.append(query[0], query[1], r.content, encoding=r.encoding)
+        return r
+
+    @staticmethod
+    def build_response(request, page):
+        """
+        :param request: requests.PreparedRequest
+        :param page: ArchivedPage, or None if the page isn't in the archive.
+        :return: requests.Response with the page, or a 404 response.
+        """
+        r = Response()
+        r.request = request
+        r.url = request.url
+        r.connection = None
+        content = page.content if page is not None else b""
+        # The content is already read, so streamed requests iterate over it instead of reading raw
+        r._content = content  # pylint: disable=protected-access
+        r._content_consumed = True  # pylint: disable=protected-access
+        r.raw = io.BytesIO(content)
+        if page is None:
+            r.status_code = 404
+            r.reason = "Not in archive"
+            r.headers = CaseInsensitiveDict()
+            return r
+        r.status_code = 200
+        r.reason = "OK"
+        content_type = "text/html" + ("; charset={}".format(page.encoding) if page.encoding else "")
+        r.headers = CaseInsensitiveDict({"Content-Type": content_type, "X-Archive-Fetched-At": str(page.fetched_at)})
+        r.encoding = page.encoding
+        return r
+
+    def close(self):
+        if self.fallback is not None:
+            self.fallback.close()
@@ -0,0 +1,131 @@
+import asyncio
+import copy
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from requests.utils import get_encoding_from_headers
+from safer.api import HEADERS, SAFER_KEYWORD_URL, SAFER_QUERY_URL, search_params, snapshot_form
+from safer.search import (
+    MC_MX_NOT_FOUND_MESSAGE,
+    USDOT_NOT_FOUND_MESSAGE,
+    build_company,
+    build_search_result_set,
+    raise_for_safer_status,
+)
+
+# HEADERS advertise every encoding urllib3 can decode, which may include ones aiohttp can't, such as zstd
+ASYNC_HEADERS = dict(HEADERS, **{"Accept-Encoding": "gzip, deflate"})
+from safer.singleflight import AsyncSingleFlight
+
+
+class AsyncCompanySnapshot:
+    """
+    asyncio version of CompanySnapshot, requests are made with aiohttp and parsed with the same code as CompanySnapshot.
+
+    Use it as an async context manager, or call close() when done, so the underlying aiohttp session is released.
+
+    Concurrent identical lookups are coalesced by `flights`: tasks that ask for a Company or a search that's already
+    being fetched await that fetch instead of making their own request.
+    """
+
+    def __init__(self, max_concurrency=10, session=None):
+        """
+        :param max_concurrency: Maximum number of requests to SAFER that can be in flight at the same time.
+        :param session: Optional aiohttp.ClientSession to use, it is not closed by close().
+        """
+        if aiohttp is None:
+            raise ImportError(
+                "AsyncCompanySnapshot requires aiohttp, install it with 'pip install python-safer[async]'"
+            )
+        if max_concurrency < 1:
+            raise ValueError("'max_concurrency' must be at least 1")
+
+        self.__max_concurrency = max_concurrency
+        self.__semaphore = asyncio.Semaphore(max_concurrency)
+        self.__session = session
+        self.__owns_session = session is None
+        self.flights = AsyncSingleFlight()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        if self.__owns_session and self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+    def __get_session(self):
+        if self.__session is None:
+            self.__session = aiohttp.ClientSession(
+                headers=ASYNC_HEADERS,
+                connector=aiohttp.TCPConnector(limit=self.__max_concurrency),
+            )
+        return self.__session
+
+    async def __request(self, method, url, **kwargs):
+        """
+        :return: (bytes, encoding) tuple of the page, the bytes as they were received so they are parsed and hashed
+            like the pages of CompanySnapshot.
+        """
+        async with self.__semaphore:
+            async with self.__get_session().request(method, url, **kwargs) as r:
+                content = await r.read()
+        raise_for_safer_status(r.status, r.reason)
+        # The encoding requests would give the page, so both clients parse it the same way
+        return content, get_encoding_from_headers(r.headers)
+
+    async def search(self, name):
+        """
+        Searches the CompanySnapshot using a name,
+
+        :param name: A company name.
+        :return: SearchResultSet Class with multiple SearchResults.
+        """
+        if name == "":
+            raise ValueError("'name' parameter must not be empty")
+
+        async def fetch():
+            content, encoding = await self.__request("GET", SAFER_KEYWORD_URL, params=search_params(name))
+            return build_search_result_set(content, name, encoding=encoding)
+
+        # Every caller gets its own copy of the shared SearchResultSet, so each one has its own iterator
+        return copy.copy(await self.flights.do(("search", name), fetch))
+
+    async def get_by_mc_mx_number(self, number):
+        """
+        Gets the Company Snapshot of a given MC/MX Number.
+
+        :param number: MC/MX Number
+        :return: Company Class.
+        """
+        if isinstance(number, str):
+            raise ValueError("parameter 'number' must be an int.")
+
+        async def fetch():
+            content, encoding = await self.__request("POST", SAFER_QUERY_URL, data=snapshot_form("MC_MX", number))
+            return build_company(content, MC_MX_NOT_FOUND_MESSAGE, encoding=encoding)
+
+        return await self.flights.do(("mc_mx", number), fetch)
+
+    async def get_by_usdot_number(self, number):
+        """
+        Gets the Company Snapshot of a given USDOT Number.
+
+        :rtype: Company
+        :param number: USDOT Number
+        :return: Company class
+        """
+        if isinstance(number, str):
+            raise ValueError("parameter 'number' must be an int.")
+
+        async def fetch():
+            content, encoding = await self.__request("POST", SAFER_QUERY_URL, data=snapshot_form("USDOT", number))
+            return build_company(content, USDOT_NOT_FOUND_MESSAGE, encoding=encoding)
+
+        return await self.flights.do(("usdot", number), fetch)
@@ -0,0 +1,410 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from safer import instrumentation
+from safer.html import PARSER_VERSION
+
+
+def cache_key(query_type, identifier):
+    """
+    Builds the key a SAFER query is cached under.
+
+    :param query_type: Type of the query, one of "search", "usdot" or "mc_mx".
+    :param identifier: Name, USDOT Number or MC/MX Number that was queried.
+    :return: String key.
+    """
+    return "{}:{}".format(query_type, str(identifier).upper())
+
+
+# A parsed Company Snapshot loaded from a cache, `content_hash` is the hash of the page it was parsed from or None
+# and `validators` the ETag and Last-Modified of that page
+CompanyRecord = namedtuple("CompanyRecord", ["data", "content_hash", "validators"])
+
+
+def query_type_of(key):
+    """
+    :param key: Key built by cache_key, prefixed with "company:" for parsed records.
+    :return: Type of the query the key was built for, such as "usdot" or "company:usdot".
+    """
+    query_type, _, rest = key.partition(":")
+    if query_type == "company":
+        return query_type + ":" + rest.partition(":")[0]
+    return query_type
+
+
+def dump_company_record(data, content_hash=None, validators=None):
+    """
+    Serializes the dictionary of a parsed Company Snapshot to compact JSON, stamped with the parser version.
+
+    The validators are stored in the record they describe, so a conditional request is only ever made for the page
+    the record was parsed from.
+
+    :param data: Dictionary returned by process_company_snapshot.
+    :param content_hash: Hash of the page the dictionary was parsed from, kept so refresh can skip unchanged pages.
+    :param validators: Dictionary returned by response_validators for the response of the page, or None.
+    :return: String to store in a cache.
+    """
+    return json.dumps([PARSER_VERSION, data, content_hash, validators or {}], separators=(",", ":"))
+
+
+def load_company_record(value):
+    """
+    Deserializes a value stored by dump_company_record.
+
+    :param value: String stored in a cache.
+    :return: CompanyRecord, or None if it was parsed by a different parser version.
+    """
+    record = json.loads(value)
+    if record[0] != PARSER_VERSION:
+        return None
+    # Records stored before the hash and the validators were kept don't have them
+    return CompanyRecord(
+        record[1], record[2] if len(record) > 2 else None, record[3] if len(record) > 3 else {}
+    )
+
+
+def validators_key(key):
+    """
+    :param key: Key of a cache entry.
+    :return: Key the validators of the response behind that entry are stored under.
+    """
+    return "validators:" + key
+
+
+def response_validators(headers):
+    """
+    :param headers: Headers of a response.
+    :return: Dictionary of the validators of the response, the ETag and Last-Modified headers.
+    """
+    return {name: headers[name] for name in ("ETag", "Last-Modified") if headers.get(name)}
+
+
+def dump_validators(headers):
+    """
+    Serializes the validators of a response, the ETag and Last-Modified headers.
+
+    :param headers: Headers of the response.
+    :return: String to store in a cache, or None if the response has no validators.
+    """
+    validators = response_validators(headers)
+    return json.dumps(validators, separators=(",", ":")) if validators else None
+
+
+def validator_headers(validators):
+    """
+    Builds the headers of a conditional request from validators.
+
+    :param validators: Dictionary returned by response_validators.
+    :return: Dictionary with If-None-Match and/or If-Modified-Since.
+    """
+    headers = {}
+    if "ETag" in validators:
+        headers["If-None-Match"] = validators["ETag"]
+    if "Last-Modified" in validators:
+        headers["If-Modified-Since"] = validators["Last-Modified"]
+    return headers
+
+
+def conditional_headers(value):
+    """
+    Builds the headers of a conditional request from stored validators.
+
+    :param value: String stored by dump_validators.
+    :return: Dictionary with If-None-Match and/or If-Modified-Since.
+    """
+    return validator_headers(json.loads(value))
+
+
+class CachedResponse:  # pylint: disable=too-few-public-methods
+    """
+    Stands in for a requests.Response when the response is served from a cache.
+    """
+
+    status_code = 200
+    reason = "OK"
+    encoding = "utf-8"
+    from_cache = True
+
+    def __init__(self, text, stale=False, stored_at=None):
+        """
+        :param text: Body of the response.
+        :param stale: Whether the entry had expired, and is served while it's revalidated or because SAFER is
+            unreachable.
+        :param stored_at: Time in seconds since the epoch the response was stored or last revalidated.
+        """
+        self.text = text
+        self.stale = stale
+        self.stored_at = stored_at
+
+    @property
+    def age(self):
+        """
+        :return: Seconds since the response was stored or last revalidated, None if it's unknown.
+        """
+        return max(0.0, time.time() - self.stored_at) if self.stored_at is not None else None
+
+    @property
+    def content(self):
+        return self.text.encode(self.encoding)
+
+    def iter_content(self, chunk_size=1):
+        content = self.content
+        for start in range(0, len(content), chunk_size):
+            yield content[start:start + chunk_size]
+
+
+class BaseCache:
+    """
+    Base class of the caches, entries expire `ttl` seconds after they are stored and the hits, misses and
+    evictions are counted. Subclasses implement the storage in _load, _store and _delete.
+    """
+
+    def __init__(self, ttl=None):
+        """
+        :param ttl: Seconds an entry stays fresh, None keeps entries until they are evicted.
+        """
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_hits = 0
+        self.revalidations = 0
+        self._lock = threading.Lock()
+
+    def _load(self, key):
+        """Returns a (value, stored_at) tuple or None."""
+        raise NotImplementedError
+
+    def _store(self, key, value, stored_at):
+        raise NotImplementedError
+
+    def _delete(self, key):
+        raise NotImplementedError
+
+    def is_expired(self, stored_at):
+        return self.ttl is not None and time.time() - stored_at > self.ttl
+
+    def get(self, key, decode=None):
+        """
+        Gets a fresh value from the cache.
+
+        :param key: Key of the entry.
+        :param decode: Optional function applied to the cached value, if it returns None the entry is evicted.
+        :return: The cached value or None if there is no fresh entry for the key.
+        """
+        entry = self.get_entry(key, decode=decode)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, key, decode=None):
+        """
+        Gets a fresh value from the cache along with the time it was stored.
+
+        :param key: Key of the entry.
+        :param decode: Optional function applied to the cached value, if it returns None the entry is evicted.
+        :return: (value, stored_at) tuple or None if there is no fresh entry for the key.
+        """
+        with self._lock:
+            entry = self._load(key)
+            value = None
+            if entry is not None and not self.is_expired(entry[1]):
+                value = entry[0] if decode is None else decode(entry[0])
+                if value is None:
+                    self._delete(key)
+                    self.evictions += 1
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if instrumentation.subscribers:
+            instrumentation.emit(
+                instrumentation.CACHE_MISS if value is None else instrumentation.CACHE_HIT,
+                1,
+                {"query_type": query_type_of(key)},
+            )
+        return (value, entry[1]) if value is not None else None
+
+    def get_stale(self, key, decode=None):
+        """
+        Gets a value from the cache whether it's fresh or not, used to fall back on when SAFER is unreachable.
+
+        :param key: Key of the entry.
+        :param decode: Optional function applied to the cached value, if it returns None the entry is evicted.
+        :return: The cached value or None if there is no entry for the key.
+        """
+        entry = self.get_stale_entry(key, decode=decode)
+        return entry[0] if entry is not None else None
+
+    def get_stale_entry(self, key, decode=None, max_stale=None):
+        """
+        Gets a value from the cache whether it's fresh or not along with the time it was stored.
+
+        :param key: Key of the entry.
+        :param decode: Optional function applied to the cached value, if it returns None the entry is evicted.
+        :param max_stale: Seconds an entry can have been expired for and still be returned, None for no limit.
+        :return: (value, stored_at) tuple or None if there is no entry for the key.
+        """
+        with self._lock:
+            entry = self._load(key)
+            if entry is None:
+                return None
+            if max_stale is not None and self.ttl is not None and time.time() - entry[1] - self.ttl > max_stale:
+                return None
+            value = entry[0] if decode is None else decode(entry[0])
+            if value is None:
+                self._delete(key)
+                self.evictions += 1
+                return None
+            self.stale_hits += 1
+        if instrumentation.subscribers:
+            instrumentation.emit(instrumentation.CACHE_STALE_HIT, 1, {"query_type": query_type_of(key)})
+        return value, entry[1]
+
+    def peek(self, key):
+        """
+        Gets a value from the cache whether it's fresh or not, without counting a hit or a miss.
+
+        :param key: Key of the entry.
+        :return: The cached value or None if there is no entry for the key.
+        """
+        with self._lock:
+            entry = self._load(key)
+            return entry[0] if entry is not None else None
+
+    def revalidate(self, key):
+        """
+        Makes an entry fresh again without changing its value, after SAFER confirmed it's unchanged.
+
+        :param key: Key of the entry.
+        :return: The cached value or None if there is no entry for the key.
+        """
+        with self._lock:
+            entry = self._load(key)
+            if entry is None:
+                return None
+            self._store(key, entry[0], time.time())
+            self.revalidations += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value, time.time())
+
+    def delete(self, key):
+        with self._lock:
+            self._delete(key)
+
+    @property
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "stale_hits": self.stale_hits,
+            "revalidations": self.revalidations,
+        }
+
+
+class MemoryCache(BaseCache):
+    """
+    In memory cache that evicts the least recently used entry once it holds `maxsize` entries.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        super().__init__(ttl=ttl)
+        if maxsize < 1:
+            raise ValueError("'maxsize' must be at least 1")
+        self.maxsize = maxsize
+        self.__entries = OrderedDict()
+
+    def _load(self, key):
+        entry = self.__entries.get(key)
+        if entry is not None:
+            self.__entries.move_to_end(key)
+        return entry
+
+    def _store(self, key, value, stored_at):
+        self.__entries[key] = (value, stored_at)
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.maxsize:
+            self.__entries.popitem(last=False)
+            self.evictions += 1
+
+    def _delete(self, key):
+        self.__entries.pop(key, None)
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+class SQLiteCache(BaseCache):
+    """
+    Persistent cache stored in a SQLite database, once it holds `maxsize` entries the least recently used entry is
+    evicted.
+    """
+
+    def __init__(self, path, ttl=None, maxsize=None):
+        """
+        :param path: Path of the SQLite database file, it is created if it does not exist.
+        :param ttl: Seconds an entry stays fresh, None keeps entries until they are evicted.
+        :param maxsize: Maximum number of entries, None for no limit.
+        """
+        super().__init__(ttl=ttl)
+        self.maxsize = maxsize
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        with self.__connection:
+            self.__connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries "
+                "(key TEXT PRIMARY KEY, value BLOB, stored_at REAL, accessed_at REAL)"
+            )
+            self.__connection.execute(
+                "CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)"
+            )
+
+    def _load(self, key):
+        row = self.__connection.execute(
+            "SELECT value, stored_at FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row is not None and self.maxsize is not None:
+            with self.__connection:
+                self.__connection.execute(
+                    "UPDATE entries SET accessed_at = ? WHERE key = ?", (time.time(), key)
+                )
+        return row
+
+    def _store(self, key, value, stored_at):
+        with self.__connection:
+            self.__connection.execute(
+                "INSERT OR REPLACE INTO entries (key, value, stored_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, stored_at, stored_at),
+            )
+            if self.maxsize is not None:
+                evicted = self.__connection.execute(
+                    "DELETE FROM entries WHERE key IN "
+                    "(SELECT key FROM entries ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.maxsize,),
+                ).rowcount
+                self.evictions += evicted
+
+    def _delete(self, key):
+        with self.__connection:
+            self.__connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def purge_expired(self):
+        """
+        Deletes the entries that are no longer fresh, they count as evictions.
+        """
+        if self.ttl is None:
+            return
+        with self._lock, self.__connection:
+            self.evictions += self.__connection.execute(
+                "DELETE FROM entries WHERE stored_at < ?", (time.time() - self.ttl,)
+            ).rowcount
+
+    def __len__(self):
+        with self._lock:
+            return self.__connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def close(self):
+        self.__connection.close()
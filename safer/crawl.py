@@ -0,0 +1,395 @@
+"""
+Crawls the Company Snapshots of ranges of USDOT Numbers into sharded JSON Lines or Parquet files.
+
+    safer-crawl 1-100000 --output carriers --rate 5 --workers 8
+    safer-crawl --input usdots.txt --output carriers --format parquet
+
+Progress is kept in a SQLite journal in the output directory, every Company is saved in it as soon as it's fetched.
+A crawl that's stopped, or crashes, resumes where it stopped when it's run again with the same output directory: the
+USDOT Numbers that were fetched or not found are not requested again, the ones that failed are.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+from safer.api import SaferClient
+from safer.exceptions import CompanySnapshotNotFoundException
+from safer.export import dump_companies_jsonl, write_parquet
+from safer.policy import TransportPolicy
+from safer.results import Company
+from safer.search import CompanySnapshot
+
+# States of the USDOT Numbers in the journal
+DONE = "done"
+NOT_FOUND = "not_found"
+FAILED = "failed"
+
+FORMATS = ("jsonl", "parquet")
+# USDOT Numbers looked up against the journal at once
+BATCH_SIZE = 500
+
+
+def parse_range(value):
+    """
+    :param value: USDOT Number, or range of USDOT Numbers such as "1000-2000" with both ends included.
+    :return: range
+    """
+    start, _, end = value.partition("-")
+    try:
+        start = int(start)
+        end = int(end) if end else start
+    except ValueError:
+        raise argparse.ArgumentTypeError("'{}' is not a USDOT Number or a range such as 1000-2000".format(value))
+    if start < 1 or end < start:
+        raise argparse.ArgumentTypeError("'{}' is not a valid range".format(value))
+    return range(start, end + 1)
+
+
+def read_ranges(path):
+    """
+    :param path: Path of a file with a USDOT Number or range per line, blank lines and lines starting with # are
+        skipped.
+    :return: Generator of ranges.
+    """
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield parse_range(line)
+
+
+def merge_ranges(ranges):
+    """
+    Merges ranges that overlap or touch, so a USDOT Number given more than once is only requested once.
+
+    :param ranges: Iterable of ranges.
+    :return: List of sorted ranges that don't overlap.
+    """
+    merged = []
+    for r in sorted(ranges, key=lambda r: r.start):
+        if merged and r.start <= merged[-1].stop:
+            merged[-1] = range(merged[-1].start, max(merged[-1].stop, r.stop))
+        else:
+            merged.append(r)
+    return merged
+
+
+class CrawlJournal:
+    """
+    SQLite journal of a crawl, it holds the state of every USDOT Number that was requested, the Companies that were
+    fetched but not written to a shard yet, and the shards that were written.
+
+    A Company is staged in the journal as soon as it's fetched, in the same transaction as its USDOT Number is marked
+    done, so it's never requested again. A shard is registered before it's written and its Companies are only removed
+    from the journal in the transaction that marks it complete, so a shard left incomplete by a crash is deleted on the
+    next run and its Companies are written again from the journal. Every Company is written exactly once.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path of the SQLite database file, it is created if it does not exist.
+        """
+        self.__connection = sqlite3.connect(path)
+        with self.__connection:
+            self.__connection.execute(
+                "CREATE TABLE IF NOT EXISTS usdots "
+                "(usdot INTEGER PRIMARY KEY, state TEXT, shard TEXT, error TEXT, updated_at REAL)"
+            )
+            self.__connection.execute(
+                "CREATE TABLE IF NOT EXISTS shards (name TEXT PRIMARY KEY, complete INTEGER, records INTEGER)"
+            )
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS staged (usdot INTEGER PRIMARY KEY, record TEXT)")
+
+    def pending(self, usdots):
+        """
+        :param usdots: Iterable of USDOT Numbers.
+        :return: Generator of the USDOT Numbers that weren't fetched or found not to exist yet.
+        """
+        batch = []
+        for usdot in usdots:
+            batch.append(usdot)
+            if len(batch) == BATCH_SIZE:
+                yield from self.__pending(batch)
+                batch = []
+        yield from self.__pending(batch)
+
+    def __pending(self, batch):
+        if not batch:
+            return []
+        finished = {
+            row[0]
+            for row in self.__connection.execute(
+                "SELECT usdot FROM usdots WHERE state IN (?, ?) AND usdot IN ({})".format(",".join("?" * len(batch))),
+                [DONE, NOT_FOUND] + batch,
+            )
+        }
+        return [usdot for usdot in batch if usdot not in finished]
+
+    def incomplete_shards(self):
+        """
+        :return: Names of the shards that were registered but never marked complete.
+        """
+        return [row[0] for row in self.__connection.execute("SELECT name FROM shards WHERE complete = 0")]
+
+    def shard_count(self):
+        return self.__connection.execute("SELECT COUNT(*) FROM shards").fetchone()[0]
+
+    def begin_shard(self, name):
+        with self.__connection:
+            self.__connection.execute(
+                "INSERT OR REPLACE INTO shards (name, complete, records) VALUES (?, 0, 0)", (name,)
+            )
+
+    def stage(self, usdot, record):
+        """
+        Saves a fetched Company until it's written to a shard and marks its USDOT Number done, in one transaction.
+
+        :param usdot: USDOT Number.
+        :param record: JSON of the dictionary of the Company.
+        """
+        with self.__connection:
+            self.__connection.execute("INSERT OR REPLACE INTO staged (usdot, record) VALUES (?, ?)", (usdot, record))
+            self.__connection.execute(
+                "INSERT OR REPLACE INTO usdots (usdot, state, shard, error, updated_at) VALUES (?, ?, NULL, NULL, ?)",
+                (usdot, DONE, time.time()),
+            )
+
+    def staged_count(self):
+        return self.__connection.execute("SELECT COUNT(*) FROM staged").fetchone()[0]
+
+    def staged(self, limit):
+        """
+        :param limit: Maximum number of Companies to return.
+        :return: List of (USDOT Number, JSON of the Company) tuples of the Companies not written to a shard yet.
+        """
+        return self.__connection.execute(
+            "SELECT usdot, record FROM staged ORDER BY usdot LIMIT ?", (limit,)
+        ).fetchall()
+
+    def complete_shard(self, name, usdots):
+        """
+        Marks a shard complete and removes the Companies it holds from the journal, in one transaction.
+        """
+        now = time.time()
+        with self.__connection:
+            self.__connection.executemany(
+                "INSERT OR REPLACE INTO usdots (usdot, state, shard, error, updated_at) VALUES (?, ?, ?, NULL, ?)",
+                [(usdot, DONE, name, now) for usdot in usdots],
+            )
+            self.__connection.executemany("DELETE FROM staged WHERE usdot = ?", [(usdot,) for usdot in usdots])
+            self.__connection.execute(
+                "UPDATE shards SET complete = 1, records = ? WHERE name = ?", (len(usdots), name)
+            )
+
+    def discard_shard(self, name):
+        with self.__connection:
+            self.__connection.execute("DELETE FROM shards WHERE name = ?", (name,))
+
+    def record(self, usdot, state, error=None):
+        """
+        Records a USDOT Number that was not found or failed, the ones that are fetched are recorded by stage.
+        """
+        with self.__connection:
+            self.__connection.execute(
+                "INSERT OR REPLACE INTO usdots (usdot, state, shard, error, updated_at) VALUES (?, ?, NULL, ?, ?)",
+                (usdot, state, error, time.time()),
+            )
+
+    def counts(self):
+        """
+        :return: Dictionary of the number of USDOT Numbers in each state.
+        """
+        counts = dict.fromkeys((DONE, NOT_FOUND, FAILED), 0)
+        counts.update(self.__connection.execute("SELECT state, COUNT(*) FROM usdots GROUP BY state").fetchall())
+        return counts
+
+    def close(self):
+        self.__connection.close()
+
+
+class ShardWriter:
+    """
+    Stages Companies in the journal and writes them to a new shard file once `shard_size` of them are staged.
+    """
+
+    def __init__(self, journal, output, file_format="jsonl", shard_size=10000):
+        """
+        :param journal: CrawlJournal the shards are registered in.
+        :param output: Directory the shards are written to.
+        :param file_format: "jsonl" or "parquet".
+        :param shard_size: Number of Companies per shard.
+        """
+        if file_format not in FORMATS:
+            raise ValueError("'file_format' must be either 'jsonl' or 'parquet'")
+        if shard_size < 1:
+            raise ValueError("'shard_size' must be at least 1")
+        self.journal = journal
+        self.output = output
+        self.file_format = file_format
+        self.shard_size = shard_size
+        # Companies staged by a previous run that stopped before writing them are written with the next shard
+        self.__staged = journal.staged_count()
+        self.__next_shard = journal.shard_count()
+
+    def add(self, company):
+        """
+        Stages a Company in the journal, it's not requested again from then on.
+
+        :return: Path of the shard written if `shard_size` Companies are staged, otherwise None.
+        """
+        self.journal.stage(int(company.usdot), json.dumps(company.to_dict(), separators=(",", ":")))
+        self.__staged += 1
+        if self.__staged >= self.shard_size:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """
+        Writes up to `shard_size` of the staged Companies to a new shard.
+
+        :return: Path of the shard, or None if no Companies were staged.
+        """
+        staged = self.journal.staged(self.shard_size)
+        if not staged:
+            return None
+        companies = [Company(data=json.loads(record)) for _, record in staged]
+        name = "part-{:05d}.{}".format(self.__next_shard, self.file_format)
+        self.__next_shard += 1
+        path = os.path.join(self.output, name)
+        tmp_path = path + ".tmp"
+
+        self.journal.begin_shard(name)
+        if self.file_format == "jsonl":
+            with open(tmp_path, "wb") as fp:
+                dump_companies_jsonl(companies, fp)
+                fp.flush()
+                os.fsync(fp.fileno())
+        else:
+            write_parquet(companies, tmp_path)
+        os.replace(tmp_path, path)
+        self.journal.complete_shard(name, [usdot for usdot, _ in staged])
+        self.__staged = max(0, self.__staged - len(staged))
+        return path
+
+
+def recover(journal, output):
+    """
+    Deletes the shards a previous run didn't complete, their Companies are still staged in the journal so they are
+    written again.
+
+    :return: Names of the deleted shards.
+    """
+    names = journal.incomplete_shards()
+    for name in names:
+        for path in (os.path.join(output, name), os.path.join(output, name) + ".tmp"):
+            if os.path.exists(path):
+                os.remove(path)
+        journal.discard_shard(name)
+    return names
+
+
+def crawl(usdots, journal, writer, client, workers=8):
+    """
+    Requests the snapshots of the USDOT Numbers the journal doesn't have yet and writes the Companies to shards, along
+    with the ones a previous run fetched but didn't write.
+
+    :param usdots: Iterable of USDOT Numbers.
+    :param journal: CrawlJournal
+    :param writer: ShardWriter
+    :param client: SaferClient to make the requests with.
+    :param workers: Number of requests to make at the same time.
+    :return: Dictionary with the number of USDOT Numbers of this run in each state.
+    """
+    counts = dict.fromkeys((DONE, NOT_FOUND, FAILED), 0)
+    batch = []
+
+    def run(batch):
+        for (_, usdot), result in CompanySnapshot.get_many(usdots=batch, max_workers=workers, client=client):
+            if isinstance(result, CompanySnapshotNotFoundException):
+                journal.record(usdot, NOT_FOUND)
+                counts[NOT_FOUND] += 1
+            elif isinstance(result, Exception):
+                journal.record(usdot, FAILED, "{}: {}".format(type(result).__name__, result))
+                counts[FAILED] += 1
+            else:
+                counts[DONE] += 1
+                path = writer.add(result)
+                if path is not None:
+                    print("wrote {}".format(path), file=sys.stderr)
+
+    # get_many submits every lookup it's given at once, so they are handed over in batches
+    for usdot in journal.pending(usdots):
+        batch.append(usdot)
+        if len(batch) == workers * 64:
+            run(batch)
+            batch = []
+    if batch:
+        run(batch)
+    path = writer.flush()
+    while path is not None:
+        print("wrote {}".format(path), file=sys.stderr)
+        path = writer.flush()
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="safer-crawl", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("ranges", nargs="*", type=parse_range, help="USDOT Numbers or ranges such as 1000-2000")
+    parser.add_argument(
+        "--input", action="append", default=[], help="File with a USDOT Number or range per line, can be repeated"
+    )
+    parser.add_argument("--output", required=True, help="Directory the shards and the journal are written to")
+    parser.add_argument("--format", choices=FORMATS, default="jsonl", help="Format of the shards")
+    parser.add_argument("--shard-size", type=int, default=10000, help="Companies per shard")
+    parser.add_argument("--workers", type=int, default=8, help="Requests made at the same time")
+    parser.add_argument("--rate", type=float, default=5.0, help="Requests per second, 0 to not rate limit")
+    parser.add_argument("--retries", type=int, default=3, help="Times a failed request is retried")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Seconds to wait between bytes of a response")
+    parser.add_argument("--journal", help="Path of the journal, journal.sqlite in the output directory by default")
+    args = parser.parse_args(argv)
+    if not args.ranges and not args.input:
+        parser.error("give USDOT Numbers or ranges, or an --input file")
+
+    ranges = list(args.ranges)
+    for path in args.input:
+        ranges.extend(read_ranges(path))
+    ranges = merge_ranges(ranges)
+
+    def usdots():
+        for usdot_range in ranges:
+            yield from usdot_range
+
+    os.makedirs(args.output, exist_ok=True)
+    journal = CrawlJournal(args.journal or os.path.join(args.output, "journal.sqlite"))
+    client = SaferClient(
+        pool_maxsize=args.workers,
+        read_timeout=args.timeout,
+        policy=TransportPolicy(rate=args.rate or None, burst=args.workers, max_retries=args.retries),
+    )
+    try:
+        for name in recover(journal, args.output):
+            print("deleted incomplete shard {}".format(name), file=sys.stderr)
+        writer = ShardWriter(journal, args.output, file_format=args.format, shard_size=args.shard_size)
+        counts = crawl(usdots(), journal, writer, client, workers=args.workers)
+        totals = journal.counts()
+    except KeyboardInterrupt:
+        # The Companies that were fetched are staged in the journal, the next run writes them without requesting them
+        print("stopped, run again to resume", file=sys.stderr)
+        return 130
+    finally:
+        client.close()
+        journal.close()
+    print(
+        "this run: {} fetched, {} not found, {} failed; journal: {} fetched, {} not found, {} failed".format(
+            counts[DONE], counts[NOT_FOUND], counts[FAILED], totals[DONE], totals[NOT_FOUND], totals[FAILED]
+        )
+    )
+    return 1 if counts[FAILED] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,9 @@
-from lxml import html
+import codecs
+import threading
+import time
+from collections import namedtuple
+from lxml import etree, html
+from safer import instrumentation
 
 
 def parse_html_to_tree(html_string):
@@ -17,3 +22,77 @@ def parse_html_to_tree(html_string):
         return None
     tree = html.fromstring(html_string)
     return tree
+
+
+# States of a parsed page
+PAGE_OK = "ok"
+PAGE_NOT_FOUND = "not_found"
+PAGE_EMPTY = "empty"
+
+# A parsed page, `tree` is the root element when the state is PAGE_OK and None otherwise
+ParsedPage = namedtuple("ParsedPage", ["state", "tree"])
+
+# SAFER's "no records" markers
+NOT_FOUND_MARKERS = ("Sorry, no records matching", "BEGIN: No records found error")
+NOT_FOUND_MARKERS_BYTES = tuple(marker.encode("ascii") for marker in NOT_FOUND_MARKERS)
+
+
+# lxml parsers can't be shared between threads, every thread keeps its own parser per encoding
+_parsers = threading.local()
+
+
+def normalize_encoding(encoding):
+    """
+    :param encoding: Name of an encoding, such as requests.Response.encoding, or None.
+    :return: Canonical name of the encoding, or None if Python doesn't know it so it's detected from the page.
+    """
+    if encoding is None:
+        return None
+    try:
+        # libxml2 doesn't know every alias Python does, such as "latin-1", but it knows their canonical names
+        return codecs.lookup(encoding).name
+    except LookupError:
+        return None
+
+
+def _parser(encoding):
+    encoding = normalize_encoding(encoding)
+    parsers = _parsers.__dict__.setdefault("parsers", {})
+    parser = parsers.get(encoding)
+    if parser is None:
+        try:
+            parser = html.HTMLParser(encoding=encoding)
+        except LookupError:
+            # An encoding libxml2 doesn't support at all, lxml detects it from the page instead
+            parser = html.HTMLParser()
+        parsers[encoding] = parser
+    return parser
+
+
+def parse_page(page, encoding=None):
+    """
+    Parses a page from SAFER. Bytes are handed to lxml as they are, such as request.content, so the page is never
+    decoded into a string first and the "no records" markers are searched for in the bytes.
+
+    :param page: Bytes or string of html.
+    :param encoding: Encoding of the bytes, such as request.encoding, None to let lxml detect it.
+    :return: ParsedPage with the state PAGE_OK and the tree, PAGE_NOT_FOUND if SAFER had no records, or PAGE_EMPTY
+        if the page has no content.
+    """
+    # The markers are ASCII, so they are searched for in the bytes without decoding them
+    markers = NOT_FOUND_MARKERS_BYTES if isinstance(page, bytes) else NOT_FOUND_MARKERS
+    if any(marker in page for marker in markers):
+        return ParsedPage(PAGE_NOT_FOUND, None)
+    start = time.perf_counter() if instrumentation.subscribers else None
+    try:
+        if isinstance(page, bytes):
+            tree = html.fromstring(page, parser=_parser(encoding))
+        else:
+            tree = html.fromstring(page)
+    except etree.ParserError:
+        return ParsedPage(PAGE_EMPTY, None)
+    if start is not None:
+        instrumentation.emit(instrumentation.PARSE, time.perf_counter() - start)
+    if len(tree) == 0:
+        return ParsedPage(PAGE_EMPTY, None)
+    return ParsedPage(PAGE_OK, tree)
@@ -0,0 +1,327 @@
+import json
+from itertools import islice
+
+try:
+    import pyarrow
+    from pyarrow import parquet
+except ImportError:
+    pyarrow = None
+    parquet = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Fields of a Company that are dates, they are exported as datetimes instead of the text on the page
+DATE_FIELDS = (
+    "latest_update",
+    "out_of_service_date",
+    "mcs_150_form_date",
+    "safety_rating_date",
+    "safety_review_date",
+)
+
+# Bytes of JSON lines that are joined before they are written
+JSONL_BUFFER_SIZE = 64 * 1024
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_percent(value):
+    """Turns a percentage such as "20.72%" into 20.72, anything that isn't a number such as "N/A" is None."""
+    try:
+        return float(value.rstrip("%"))
+    except (AttributeError, ValueError):
+        return None
+
+
+def _path(*keys):
+    """
+    :return: Function that gets the value at `keys` in the dictionary of a Company, or None if any key is missing.
+    """
+
+    def get(company):
+        value = company.to_dict()
+        for key in keys:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(key)
+        return value
+
+    return get
+
+
+def _build_columns():
+    """
+    Builds the (column name, kind, getter) of every column a Company is flattened into, the getter takes a Company.
+    """
+    columns = [
+        ("usdot", "int", lambda c: _to_int(c.usdot)),
+        ("legal_name", "string", _path("legal_name")),
+        ("dba_name", "string", _path("dba_name")),
+        ("entity_type", "category", _path("entity_type")),
+        ("usdot_status", "category", _path("usdot_status")),
+        ("operating_authority_status", "category", _path("operating_authority_status")),
+        ("out_of_service_date", "timestamp", lambda c: c.out_of_service_date),
+        ("state_carrier_id", "string", _path("state_carrier_id")),
+        ("mc_mx_ff_numbers", "string", _path("mc_mx_ff_numbers")),
+        ("duns_number", "string", _path("duns_number")),
+        ("phone", "string", _path("phone")),
+        ("physical_address", "string", _path("physical_address")),
+        ("mailing_address", "string", _path("mailing_address")),
+        ("power_units", "int", _path("power_units")),
+        ("drivers", "int", _path("drivers")),
+        ("mcs_150_form_date", "timestamp", lambda c: c.mcs_150_form_date),
+        ("mcs_150_mileage", "int", _path("mcs_150_mileage_year", "mileage")),
+        ("mcs_150_year", "int", _path("mcs_150_mileage_year", "year")),
+        ("operation_classification", "categories", _path("operation_classification")),
+        ("carrier_operation", "categories", _path("carrier_operation")),
+        ("hm_shipper_operation", "categories", _path("hm_shipper_operation")),
+        ("cargo_carried", "categories", _path("cargo_carried")),
+        ("safety_rating", "category", _path("safety_rating")),
+        ("safety_type", "category", _path("safety_type")),
+        ("safety_rating_date", "timestamp", lambda c: c.safety_rating_date),
+        ("safety_review_date", "timestamp", lambda c: c.safety_review_date),
+        ("latest_update", "timestamp", lambda c: c.latest_update),
+        ("url", "string", _path("url")),
+    ]
+
+    # us_inspections holds the counts as numbers, united_states_inspections as they are written on the page
+    inspections = [("united_states", "us_inspections", ("vehicle", "driver", "hazmat", "iep"))]
+    inspections.append(("canada", "canada_inspections", ("vehicle", "driver")))
+    for country, key, types in inspections:
+        for inspection_type in types:
+            prefix = "{}_inspections_{}_".format(country, inspection_type)
+            count = _path(key, inspection_type, "inspections")
+            out_of_service = _path(key, inspection_type, "out_of_service")
+            percent = _path(key, inspection_type, "out_of_service_percent")
+            columns.append((prefix + "inspections", "int", lambda c, get=count: _to_int(get(c))))
+            columns.append((prefix + "out_of_service", "int", lambda c, get=out_of_service: _to_int(get(c))))
+            columns.append((prefix + "out_of_service_percent", "float", lambda c, get=percent: _to_percent(get(c))))
+            if country == "united_states":
+                average = _path(key, inspection_type, "national_average")
+                columns.append((prefix + "national_average", "float", lambda c, get=average: _to_percent(get(c))))
+
+    for country in ("united_states", "canada"):
+        for crash_type in ("fatal", "injury", "tow", "total"):
+            get = _path(country + "_crashes", crash_type)
+            columns.append(("{}_crashes_{}".format(country, crash_type), "int", lambda c, get=get: _to_int(get(c))))
+    return columns
+
+
+COLUMNS = _build_columns()
+
+
+def _arrow_type(kind):
+    return {
+        "int": pyarrow.int64(),
+        "float": pyarrow.float64(),
+        "string": pyarrow.string(),
+        "timestamp": pyarrow.timestamp("s"),
+        "category": pyarrow.dictionary(pyarrow.int32(), pyarrow.string()),
+        "categories": pyarrow.list_(pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+    }[kind]
+
+
+def _require_pyarrow():
+    if pyarrow is None:
+        raise ImportError("Exporting to Arrow requires pyarrow, install it with 'pip install python-safer[arrow]'")
+
+
+def arrow_schema():
+    """
+    :return: pyarrow.Schema of the flattened Company columns.
+    """
+    _require_pyarrow()
+    return pyarrow.schema([(name, _arrow_type(kind)) for name, kind, _ in COLUMNS])
+
+
+class _Categories:
+    """
+    Dictionary of the values of a categorical column. Values are only ever appended, so the dictionary of every
+    batch extends the one of the batch before it and can be written as a delta.
+    """
+
+    def __init__(self):
+        self.values = []
+        self.indices = {}
+
+    def index(self, value):
+        index = self.indices.get(value)
+        if index is None:
+            index = self.indices[value] = len(self.values)
+            self.values.append(value)
+        return index
+
+    def dictionary_array(self, indices):
+        return pyarrow.DictionaryArray.from_arrays(
+            pyarrow.array(indices, pyarrow.int32()), pyarrow.array(self.values, pyarrow.string())
+        )
+
+
+class CompanyTable:
+    """
+    Turns Companies into Arrow record batches of typed columns. Nested inspections and crashes are flattened into
+    their own columns, and lists such as cargo_carried become lists of dictionary encoded categories.
+    """
+
+    def __init__(self):
+        _require_pyarrow()
+        self.schema = arrow_schema()
+        self.__categories = {name: _Categories() for name, kind, _ in COLUMNS if kind in ("category", "categories")}
+
+    def __column(self, name, kind, values):
+        if kind == "category":
+            categories = self.__categories[name]
+            return categories.dictionary_array([None if v is None else categories.index(v) for v in values])
+        if kind == "categories":
+            categories = self.__categories[name]
+            offsets = [0]
+            indices = []
+            for items in values:
+                indices += [categories.index(item) for item in items or ()]
+                offsets.append(len(indices))
+            return pyarrow.ListArray.from_arrays(
+                pyarrow.array(offsets, pyarrow.int32()),
+                categories.dictionary_array(indices),
+                mask=pyarrow.array([items is None for items in values]),
+            )
+        return pyarrow.array(values, _arrow_type(kind))
+
+    def record_batch(self, companies):
+        """
+        :param companies: List of Companies.
+        :return: pyarrow.RecordBatch with a row per Company.
+        """
+        arrays = [self.__column(name, kind, [get(c) for c in companies]) for name, kind, get in COLUMNS]
+        return pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+    def iter_record_batches(self, companies, chunk_size=10000):
+        """
+        :param companies: Iterable of Companies, it's consumed `chunk_size` Companies at a time.
+        :param chunk_size: Number of rows per record batch.
+        :return: Generator of pyarrow.RecordBatch.
+        """
+        companies = iter(companies)
+        while True:
+            chunk = list(islice(companies, chunk_size))
+            if not chunk:
+                return
+            yield self.record_batch(chunk)
+
+
+def companies_to_arrow(companies, chunk_size=10000):
+    """
+    Builds a pyarrow.Table of typed columns from Companies.
+
+    :param companies: Iterable of Companies.
+    :param chunk_size: Number of rows per record batch of the table.
+    :return: pyarrow.Table
+    """
+    table = CompanyTable()
+    return pyarrow.Table.from_batches(list(table.iter_record_batches(companies, chunk_size)), schema=table.schema)
+
+
+def write_parquet(companies, path, chunk_size=10000, compression="zstd"):
+    """
+    Writes Companies to a Parquet file a chunk at a time, so only `chunk_size` Companies are held in memory.
+
+    :param companies: Iterable of Companies.
+    :param path: Path or file object to write to.
+    :param chunk_size: Number of rows per row group.
+    :param compression: Parquet compression codec.
+    :return: Number of rows written.
+    """
+    table = CompanyTable()
+    rows = 0
+    with parquet.ParquetWriter(path, table.schema, compression=compression) as writer:
+        for batch in table.iter_record_batches(companies, chunk_size):
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    return rows
+
+
+def write_feather(companies, path, chunk_size=10000, compression="zstd"):
+    """
+    Writes Companies to a Feather (Arrow IPC) file a chunk at a time, so only `chunk_size` Companies are held in
+    memory.
+
+    :param companies: Iterable of Companies.
+    :param path: Path or file object to write to.
+    :param chunk_size: Number of rows per record batch.
+    :param compression: "zstd", "lz4" or None.
+    :return: Number of rows written.
+    """
+    table = CompanyTable()
+    rows = 0
+    # The dictionaries of the categorical columns only grow, so every batch after the first writes a delta of them
+    options = pyarrow.ipc.IpcWriteOptions(compression=compression, emit_dictionary_deltas=True)
+    with pyarrow.ipc.new_file(path, table.schema, options=options) as writer:
+        for batch in table.iter_record_batches(companies, chunk_size):
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    return rows
+
+
+def company_record(company):
+    """
+    :param company: Company
+    :return: Dictionary of the Company with its dates as datetimes, under the same keys as Company.to_dict().
+    """
+    record = dict(company.to_dict())
+    for field in DATE_FIELDS:
+        record[field] = getattr(company, field)
+    return record
+
+
+def _encode_datetime(value):
+    # Gives the same ISO 8601 text as orjson, so the output doesn't depend on which encoder is installed
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+
+
+if orjson is not None:
+
+    def _encode_line(record):
+        return orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE)  # pylint: disable=no-member
+
+else:
+    _encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False, default=_encode_datetime)
+
+    def _encode_line(record):
+        return (_encoder.encode(record) + "\n").encode("utf-8")
+
+
+def dump_companies_jsonl(companies, fp):
+    """
+    Writes Companies as newline delimited JSON, one Company per line, with orjson if it's installed. Dates are written
+    as ISO 8601 datetimes such as "2017-09-12T00:00:00", or null.
+
+    Lines are written as the Companies are consumed, a few at a time, so the whole output is never held in memory.
+
+    :param companies: Iterable of Companies.
+    :param fp: File object opened in binary mode, such as open(path, "wb") or socket.makefile("wb").
+    :return: Number of Companies written.
+    """
+    count = 0
+    buffer = []
+    size = 0
+    for company in companies:
+        line = _encode_line(company_record(company))
+        buffer.append(line)
+        size += len(line)
+        count += 1
+        if size >= JSONL_BUFFER_SIZE:
+            fp.write(b"".join(buffer))
+            buffer = []
+            size = 0
+    if buffer:
+        fp.write(b"".join(buffer))
+    return count
@@ -1,6 +1,10 @@
 import re
 from urllib.parse import parse_qsl, urlencode
-from lxml import html
+from lxml import etree, html
+from safer.crawler import normalize_encoding
+
+# Bump this whenever a change to the parsing changes its output, cached parsed records of older versions are discarded.
+PARSER_VERSION = 2
 
 
 def debug_print_element(e):
@@ -14,23 +18,43 @@ def get_first_item_or_none(items):
     return items[0]
 
 
+# Characters removed from the text extracted from the pages
+UNWANTED_CHARACTERS = ("\n", "\t", "\r", "\xa0")
+# SAFER writes "None" in fields that have no value
+NONE_SENTINEL = "none"
+
+
+def remove_unwanted_characters(text):
+    """
+    Removes newlines, tabs, carriage returns and non-breaking spaces from the text. str.replace returns the text itself
+    when there is nothing to replace, so text without them isn't copied.
+
+    :param text: String.
+    :return: The text without the unwanted characters.
+    """
+    for character in UNWANTED_CHARACTERS:
+        text = text.replace(character, "")
+    return text
+
+
 def process_extracted_text(extracted_data):
     if isinstance(extracted_data, list):
         if len(extracted_data) > 1:
-            # Joins the list of string together and uses re.sub to remove all unwanted unicode ascii characters.
-            return " ".join(
-                [re.sub("[\n\t\r\xa0]+", "", x.strip()) for x in extracted_data]
-            ).strip()
+            # Joins the list of strings together and removes all unwanted characters in one pass.
+            return remove_unwanted_characters(" ".join([x.strip() for x in extracted_data])).strip()
         if len(extracted_data) == 0:
             return None
-        if "none" in extracted_data[0].lower():
-            return None
-        return extracted_data[0].strip()
-    if isinstance(extracted_data, str):
-        if "none" in extracted_data.lower() or extracted_data.lower() == "":
+        text = extracted_data[0].strip()
+    elif isinstance(extracted_data, str):
+        if extracted_data == "":
             return None
-        return extracted_data.strip()
-    raise ValueError("Unrecognized parsing result.")
+        text = extracted_data.strip()
+    else:
+        raise ValueError("Unrecognized parsing result.")
+    # Only the exact sentinel is None, names that contain "none" such as "NONESUCH TRUCKING" are kept
+    if len(text) == 4 and text.lower() == NONE_SENTINEL:
+        return None
+    return text
 
 
 def process_final_dictionary(data):
@@ -186,6 +210,45 @@ def process_final_dictionary(data):
     return data
 
 
+def _xpath(path):
+    # smart_strings=False returns plain strings that don't keep a reference to the whole tree alive
+    return etree.XPath(path, smart_strings=False)
+
+
+# Xpaths of the search results page.
+SEARCH_RESULT_ROWS = _xpath("//tr[.//*[@scope='rpw']]")
+SEARCH_RESULT_ROW_HEADER = "th[@scope='rpw']"
+SEARCH_RESULT_ID = _xpath("th/b/a/@href")
+SEARCH_RESULT_NAME = _xpath("th/b/a/text()")
+SEARCH_RESULT_LOCATION = _xpath("td/b/text()")
+
+
+def process_search_result_row(item):
+    """
+        Parses a single row of the table of search results.
+
+    :param item: lxml element of the table row.
+    :return: Dictionary of the result, "html" holds the row element itself so it's only serialized when needed.
+    """
+    c_name = SEARCH_RESULT_NAME(item)[0]
+    c_id = SEARCH_RESULT_ID(item)[0]
+    # Formatting the state and city properly
+    c_location = SEARCH_RESULT_LOCATION(item)[0].title().split(", ")
+    c_location = "{}, {}".format(c_location[0], c_location[1].upper())
+    # Parsing the USDOT number out of the xpath
+    c_id_parsed = parse_qsl(c_id[10:])
+
+    return {
+        "name": c_name,
+        "id": c_id_parsed[4][1],
+        "location": c_location,
+        "html": item,
+        "url": "http://www.safersys.org/query.asp?{}".format(
+            urlencode(c_id_parsed)
+        ),
+    }
+
+
 def process_search_result_html(tree):
     """
         Parses the search results from the HTML, the HTML comes in as an lxml.etree._ElementTree.
@@ -196,302 +259,231 @@ def process_search_result_html(tree):
     :return: List of parsed results
     """
 
-    # List that will be returned
-    result_set = []
+    # Parses every row of the table of search results.
+    return [process_search_result_row(item) for item in SEARCH_RESULT_ROWS(tree)[1:]]
 
-    # Set of xpaths needed to return specifc values.
-    fields = {"id": "th/b/a/@href", "name": "th/b/a/text()", "location": "td/b/text()"}
 
-    # Parses every row of the table of search results.
-    for item in tree.xpath("//tr[.//*[@scope='rpw']]")[1:]:
-        c_name = item.xpath(fields["name"])[0]
-        c_id = item.xpath(fields["id"])[0]
-        # Formatting the state and city properly
-        c_location = item.xpath(fields["location"])[0].title().split(", ")
-        c_location = "{}, {}".format(c_location[0], c_location[1].upper())
-        # Parsing the USDOT number out of the xpath
-        c_id_parsed = parse_qsl(c_id[10:])
-        # Getting the Raw HTML.
-        c_raw_html = html.tostring(item, pretty_print=True)
-
-        result_set.append(
-            {
-                "name": c_name,
-                "id": c_id_parsed[4][1],
-                "location": c_location,
-                "html": c_raw_html,
-                "url": "http://www.safersys.org/query.asp?{}".format(
-                    urlencode(c_id_parsed)
-                ),
-            }
-        )
-    return result_set
+def iter_search_result_html(chunks, encoding=None):
+    """
+        Parses the search results from the HTML while it's being received, results are yielded as soon as their row
+        of the table is complete.
+
+    :param chunks: Iterable of bytes of the HTML, such as requests.Response.iter_content().
+    :param encoding: Encoding of the HTML, detected from the HTML if None.
+    :return: Generator of parsed results
+    """
+    try:
+        parser = etree.HTMLPullParser(events=("end",), tag="tr", encoding=normalize_encoding(encoding))
+    except LookupError:
+        # An encoding libxml2 doesn't support at all, it's detected from the HTML instead
+        parser = etree.HTMLPullParser(events=("end",), tag="tr")
+    for chunk in chunks:
+        parser.feed(chunk)
+        for _, item in parser.read_events():
+            if item.find(SEARCH_RESULT_ROW_HEADER) is None:
+                continue
+            result = process_search_result_row(item)
+            # Detaching the row so it's freed together with its result instead of living as long as the document
+            item.getparent().remove(item)
+            yield result
+    parser.close()
+
+
+# Precompiled extraction plan of the Company Snapshot page, the expressions are compiled once at import time
+# instead of on every call, and the tables are found in one walk of the tree instead of one scan per table.
+GENERAL_INFO_TABLE_INDEX = 6
+SNAPSHOT_TABLE_SUMMARIES = (
+    "Operation Classification",
+    "Cargo Carried",
+    "Carrier Operation",
+    "Shipper Operation",
+    "Review Information",
+    "Inspections",
+    "Crashes",
+)
+
+GENERAL_INFO_FIELDS = tuple(
+    (name, _xpath(path))
+    for name, path in (
+        ("entity_type", "tr[3]/td/text()"),
+        ("usdot_status", "tr[4]/td[1]/text()"),
+        ("legal_name", "tr[11]/td/text()"),
+        ("dba_name", "tr[12]/td/text()"),
+        ("physical_address", "tr[13]/td/text()"),
+        ("phone", "tr[14]/td/text()"),
+        ("mailing_address", "tr[15]/td/text()"),
+        ("usdot", "tr[5]/td[1]/text()"),
+        ("state_carrier_id", "tr[5]/td[2]/text()"),
+        ("mc_mx_ff_numbers", "tr[9]/td[1]/a/text()"),
+        ("duns_number", "tr[16]/td/text()"),
+        ("power_units", "tr[17]/td[1]/text()"),
+        ("drivers", "tr[17]/td[2]/font/b/text()"),
+        ("mcs_150_form_date", "tr[6]/td[1]/text()"),
+        ("mcs_150_mileage_year", "tr[6]/td[2]/font/b/text()"),
+        # Out of Service Date comes in as a string 'None' if None
+        ("out_of_service_date", "tr[4]/td[2]/text()"),
+    )
+)
+
+OPERATING_STATUS_CELLS = _xpath("tr[8]/td")
+OPERATING_STATUS_FONT_WRAPPED = _xpath("tr[8]/td[1]/font/b/text()")
+OPERATING_STATUS_NON_WRAPPED = _xpath("tr[8]/td[1]/text()")
+
+# Rows of a list of types that have an X next to them
+CHECKED_ITEMS = _xpath("tr[2]/td/table/tr[.//td[@class='queryfield']/text() = 'X']/td/font/text()")
+OPERATION_CLASSIFICATION_LAST_VALUE = _xpath("tr[2]/td[3]/table/tr[5]/td[2]/text()")
+
+
+def _cell(row, column, suffix=""):
+    return _xpath("tr[{}]/td[{}]{}/text()".format(row, column, suffix))
+
+
+US_INSPECTIONS_FIELDS = tuple(
+    (
+        kind,
+        (
+            ("inspections", _cell(2, column)),
+            ("out_of_service", _cell(3, column)),
+            ("out_of_service_percent", _cell(4, column)),
+            ("national_average", _cell(5, column, "/font")),
+        ),
+    )
+    for column, kind in enumerate(("vehicle", "driver", "hazmat", "iep"), start=1)
+)
+CANADA_INSPECTIONS_FIELDS = tuple(
+    (
+        kind,
+        (
+            ("inspections", _cell(2, column)),
+            ("out_of_service", _cell(3, column)),
+            ("out_of_service_percent", _cell(4, column)),
+        ),
+    )
+    for column, kind in enumerate(("vehicle", "driver"), start=1)
+)
+CRASHES_FIELDS = tuple(
+    (kind, _cell(2, column)) for column, kind in enumerate(("fatal", "injury", "tow", "total"), start=1)
+)
+SAFETY_RATING_FIELDS = (
+    ("safety_rating_date", _cell(2, 1)),
+    ("safety_review_date", _cell(2, 2)),
+    ("safety_rating", _cell(3, 1)),
+    ("safety_type", _cell(3, 2)),
+)
+LATEST_UPDATE = _xpath("//b/font[@color='#0000C0']/text()")
+# The same date found with a regular expression, without parsing the page
+LATEST_UPDATE_TEXT = re.compile(r"<font color=\"#0000C0\">\s*(\d{1,2}/\d{1,2}/\d{4})\s*</font>", re.IGNORECASE)
+LATEST_UPDATE_BYTES = re.compile(LATEST_UPDATE_TEXT.pattern.encode("ascii"), re.IGNORECASE)
+
+
+def find_latest_update(page):
+    """
+    Finds the "latest update" date of a Company Snapshot without parsing the page.
+
+    :param page: Bytes or string of html of the snapshot.
+    :return: The date as it's written on the page, such as "09/12/2017", or None if it's not found.
+    """
+    if isinstance(page, bytes):
+        matches = LATEST_UPDATE_BYTES.findall(page)
+        return matches[-1].decode("ascii") if matches else None
+    matches = LATEST_UPDATE_TEXT.findall(page)
+    return matches[-1] if matches else None
+
+
+def _extract_inspections(table, plan):
+    return {
+        kind: {name: process_extracted_text(path(table)) for name, path in fields}
+        for kind, fields in plan
+    }
+
+
+def _extract_crashes(table):
+    return {name: process_extracted_text(path(table)) for name, path in CRASHES_FIELDS}
 
 
 def process_company_snapshot(tree):
     """
         Parses the Company Snapshot from the HTML, the HTML comes in as an lxml.etree._ElementTree.
-        Using xpath the results are extracted and returned a dictionary of data.
+        Using the precompiled xpaths above the results are extracted and returned a dictionary of data.
 
     :rtype Dictionary
     :param tree: lxml.etree._ElementTree Object that contains the HTMl from the page
     :return: Parsed values in a dictionary
     """
 
-    general_info_table = tree.xpath("//table")[6]
-
-    operation_classification_table = tree.xpath(
-        '//table[@summary="Operation Classification"]'
-    )
-    cargo_carried_table = tree.xpath('//table[@summary="Cargo Carried"]')
-    carrier_operation_table = tree.xpath('//table[@summary="Carrier Operation"]')
-    hm_shipper_operation_table = tree.xpath('//table[@summary="Shipper Operation"]')
-    safety_rating_table = tree.xpath('//table[@summary="Review Information"]')
-
-    inspections_tables = tree.xpath('//table[@summary="Inspections"]')
-    crashes_tables = tree.xpath('//table[@summary="Crashes"]')
-
-    fields = {
-        "entity_type": "tr[3]/td/text()",
-        "usdot_status": "tr[4]/td[1]/text()",
-        "legal_name": "tr[11]/td/text()",
-        "dba_name": "tr[12]/td/text()",
-        "physical_address": "tr[13]/td/text()",
-        "phone": "tr[14]/td/text()",
-        "mailing_address": "tr[15]/td/text()",
-        "usdot": "tr[5]/td[1]/text()",
-        "state_carrier_id": "tr[5]/td[2]/text()",
-        "mc_mx_ff_numbers": "tr[9]/td[1]/a/text()",
-        "duns_number": "tr[16]/td/text()",
-        "power_units": "tr[17]/td[1]/text()",
-        "drivers": "tr[17]/td[2]/font/b/text()",
-        "mcs_150_form_date": "tr[6]/td[1]/text()",
-        "mcs_150_mileage_year": "tr[6]/td[2]/font/b/text()",
+    # Finding every table needed in one walk of the tree
+    tables = []
+    summary_tables = {summary: [] for summary in SNAPSHOT_TABLE_SUMMARIES}
+    for table in tree.iter("table"):
+        tables.append(table)
+        summary = table.get("summary")
+        if summary in summary_tables:
+            summary_tables[summary].append(table)
+
+    general_info_table = tables[GENERAL_INFO_TABLE_INDEX]
+    operation_classification_table = summary_tables["Operation Classification"]
+    cargo_carried_table = summary_tables["Cargo Carried"]
+    carrier_operation_table = summary_tables["Carrier Operation"]
+    hm_shipper_operation_table = summary_tables["Shipper Operation"]
+    safety_rating_table = summary_tables["Review Information"]
+    inspections_tables = summary_tables["Inspections"]
+    crashes_tables = summary_tables["Crashes"]
+
+    parsed_fields = {
+        name: process_extracted_text(path(general_info_table)) for name, path in GENERAL_INFO_FIELDS
     }
 
-    parsed_fields = {}
-
-    for item in fields.items():
-        parsed_fields[item[0]] = process_extracted_text(
-            general_info_table.xpath(item[1])
-        )
-
-    # Out of Service Date comes in as a string 'None' if None
-    parsed_fields["out_of_service_date"] = process_extracted_text(
-        general_info_table.xpath("tr[4]/td[2]/text()")
-    )
-
     # Getting Operating Status out of HTML, must be done outside of loop because it requires more decisiveness
-    operating_status_data_items_length = len(general_info_table.xpath("tr[8]/td"))
-    if operating_status_data_items_length > 0:
-        operating_status_font_wrapped_based = process_extracted_text(
-            general_info_table.xpath("tr[8]/td[1]/font/b/text()")
-        )
-        operating_status_non_wrapped = process_extracted_text(
-            general_info_table.xpath("tr[8]/td[1]/text()")
-        )
-
-        parsed_fields["operating_authority_status"] = (
-            operating_status_font_wrapped_based or operating_status_non_wrapped
-        )
+    if len(OPERATING_STATUS_CELLS(general_info_table)) > 0:
+        parsed_fields["operating_authority_status"] = process_extracted_text(
+            OPERATING_STATUS_FONT_WRAPPED(general_info_table)
+        ) or process_extracted_text(OPERATING_STATUS_NON_WRAPPED(general_info_table))
     else:
         parsed_fields["operating_authority_status"] = None
 
     # Getting Operation Classifications from a list of classifications if the table exists in the HTML
-    # Checks the HTML for all table rows that contain and X next to them
     if len(operation_classification_table) == 1:
-        parsed_fields["operation_classification"] = []
-        operation_classification_table = operation_classification_table.pop(0)
-        for classification in operation_classification_table.xpath(
-            "tr[2]/td/table/tr[.//td[@class='queryfield']/text() = 'X']/td/font/text()"
-        ):
-            parsed_fields["operation_classification"].append(classification)
-        last_val = operation_classification_table.xpath(
-            "tr[2]/td[3]/table/tr[5]/td[2]/text()"
-        )
+        parsed_fields["operation_classification"] = CHECKED_ITEMS(operation_classification_table[0])
+        last_val = OPERATION_CLASSIFICATION_LAST_VALUE(operation_classification_table[0])
         if len(last_val) > 0:
-            parsed_fields["operation_classification"].append(
-                process_extracted_text(last_val)
-            )
+            parsed_fields["operation_classification"].append(process_extracted_text(last_val))
 
     # Parsing out Carrier Operation from the list of types
-    # Checks the HTML for all table rows that contain and X next to them
     if len(carrier_operation_table) == 1:
-        parsed_fields["carrier_operation"] = []
-        carrier_operation_table = carrier_operation_table.pop(0)
-        for operation in carrier_operation_table.xpath(
-            "tr[2]/td/table/tr[.//td[@class='queryfield']/text() = 'X']/td/font/text()"
-        ):
-            parsed_fields["carrier_operation"].append(operation)
+        parsed_fields["carrier_operation"] = CHECKED_ITEMS(carrier_operation_table[0])
 
     # Parsing out Shipper Opertation from the list of types if the table exists in the HTML
-    # Checks the HTML for all table rows that contain and X next to thema
     if len(hm_shipper_operation_table) == 1:
-        parsed_fields["hm_shipper_operation"] = []
-        hm_shipper_operation_table = hm_shipper_operation_table.pop(0)
-        for operation in hm_shipper_operation_table.xpath(
-            "tr[2]/td/table/tr[.//td[@class='queryfield']/text() = 'X']/td/font/text()"
-        ):
-            parsed_fields["hm_shipper_operation"].append(operation)
+        parsed_fields["hm_shipper_operation"] = CHECKED_ITEMS(hm_shipper_operation_table[0])
     else:
         parsed_fields["hm_shipper_operation"] = None
 
     # Parsing out the type of cargo this carrier is authorized or carry if the table exists in the HTML
-    # Checks the HTML for all table rows that contain and X next to them
     if len(cargo_carried_table) == 1:
-        parsed_fields["cargo_carried"] = []
-        cargo_carried_table = cargo_carried_table.pop(0)
-        for cargo in cargo_carried_table.xpath(
-            "tr[2]/td/table/tr[.//td[@class='queryfield']/text() = 'X']/td/font/text()"
-        ):
-            parsed_fields["cargo_carried"].append(cargo)
-
-    # Parsing the data from tables into nested dictionaries.
+        parsed_fields["cargo_carried"] = CHECKED_ITEMS(cargo_carried_table[0])
 
-    # Parsing the inspections in the United Status if the tables exist in the HTML
+    # Parsing the data from tables into nested dictionaries, the first table is the United States and the second
+    # table is Canada.
     if len(inspections_tables) == 2:
-        us_inspections_table = inspections_tables[0]
-        parsed_fields["united_states_inspections"] = {
-            "vehicle": {
-                "inspections": process_extracted_text(
-                    us_inspections_table.xpath("tr[2]/td[1]/text()")
-                ),
-                "out_of_service": process_extracted_text(
-                    us_inspections_table.xpath("tr[3]/td[1]/text()")
-                ),
-                "out_of_service_percent": process_extracted_text(
-                    us_inspections_table.xpath("tr[4]/td[1]/text()")
-                ),
-                "national_average": process_extracted_text(
-                    us_inspections_table.xpath("tr[5]/td[1]/font/text()")
-                ),
-            },
-            "driver": {
-                "inspections": process_extracted_text(
-                    us_inspections_table.xpath("tr[2]/td[2]/text()")
-                ),
-                "out_of_service": process_extracted_text(
-                    us_inspections_table.xpath("tr[3]/td[2]/text()")
-                ),
-                "out_of_service_percent": process_extracted_text(
-                    us_inspections_table.xpath("tr[4]/td[2]/text()")
-                ),
-                "national_average": process_extracted_text(
-                    us_inspections_table.xpath("tr[5]/td[2]/font/text()")
-                ),
-            },
-            "hazmat": {
-                "inspections": process_extracted_text(
-                    us_inspections_table.xpath("tr[2]/td[3]/text()")
-                ),
-                "out_of_service": process_extracted_text(
-                    us_inspections_table.xpath("tr[3]/td[3]/text()")
-                ),
-                "out_of_service_percent": process_extracted_text(
-                    us_inspections_table.xpath("tr[4]/td[3]/text()")
-                ),
-                "national_average": process_extracted_text(
-                    us_inspections_table.xpath("tr[5]/td[3]/font/text()")
-                ),
-            },
-            "iep": {
-                "inspections": process_extracted_text(
-                    us_inspections_table.xpath("tr[2]/td[4]/text()")
-                ),
-                "out_of_service": process_extracted_text(
-                    us_inspections_table.xpath("tr[3]/td[4]/text()")
-                ),
-                "out_of_service_percent": process_extracted_text(
-                    us_inspections_table.xpath("tr[4]/td[4]/text()")
-                ),
-                "national_average": process_extracted_text(
-                    us_inspections_table.xpath("tr[5]/td[4]/font/text()")
-                ),
-            },
-        }
-
-    # Parsing the crashes in the United States if the tables exist in the HTML
+        parsed_fields["united_states_inspections"] = _extract_inspections(
+            inspections_tables[0], US_INSPECTIONS_FIELDS
+        )
     if len(crashes_tables) == 2:
-        us_crashes_table = crashes_tables[0]
-        parsed_fields["united_states_crashes"] = {
-            "fatal": process_extracted_text(
-                us_crashes_table.xpath("tr[2]/td[1]/text()")
-            ),
-            "injury": process_extracted_text(
-                us_crashes_table.xpath("tr[2]/td[2]/text()")
-            ),
-            "tow": process_extracted_text(us_crashes_table.xpath("tr[2]/td[3]/text()")),
-            "total": process_extracted_text(
-                us_crashes_table.xpath("tr[2]/td[4]/text()")
-            ),
-        }
-
-    # Parsing the inspections in Canada if the tables exist in the HTML
+        parsed_fields["united_states_crashes"] = _extract_crashes(crashes_tables[0])
     if len(inspections_tables) == 2:
-        canada_inspections_table = inspections_tables[1]
-        parsed_fields["canada_inspections"] = {
-            "vehicle": {
-                "inspections": process_extracted_text(
-                    canada_inspections_table.xpath("tr[2]/td[1]/text()")
-                ),
-                "out_of_service": process_extracted_text(
-                    canada_inspections_table.xpath("tr[3]/td[1]/text()")
-                ),
-                "out_of_service_percent": process_extracted_text(
-                    canada_inspections_table.xpath("tr[4]/td[1]/text()")
-                ),
-            },
-            "driver": {
-                "inspections": process_extracted_text(
-                    canada_inspections_table.xpath("tr[2]/td[2]/text()")
-                ),
-                "out_of_service": process_extracted_text(
-                    canada_inspections_table.xpath("tr[3]/td[2]/text()")
-                ),
-                "out_of_service_percent": process_extracted_text(
-                    canada_inspections_table.xpath("tr[4]/td[2]/text()")
-                ),
-            },
-        }
-
-    # Parsing the crashes in Canada if the tables exist in the HTML
+        parsed_fields["canada_inspections"] = _extract_inspections(
+            inspections_tables[1], CANADA_INSPECTIONS_FIELDS
+        )
     if len(crashes_tables) == 2:
-        canada_crashes_table = crashes_tables[1]
-        parsed_fields["canada_crashes"] = {
-            "fatal": process_extracted_text(
-                canada_crashes_table.xpath("tr[2]/td[1]/text()")
-            ),
-            "injury": process_extracted_text(
-                canada_crashes_table.xpath("tr[2]/td[2]/text()")
-            ),
-            "tow": process_extracted_text(
-                canada_crashes_table.xpath("tr[2]/td[3]/text()")
-            ),
-            "total": process_extracted_text(
-                canada_crashes_table.xpath("tr[2]/td[4]/text()")
-            ),
-        }
+        parsed_fields["canada_crashes"] = _extract_crashes(crashes_tables[1])
 
     # Parsing the Safety Rating if it exists in the HTML
     if len(safety_rating_table) == 1:
-        safety_rating_table = safety_rating_table.pop(0)
-        parsed_fields["safety_rating_date"] = process_extracted_text(
-            safety_rating_table.xpath("tr[2]/td[1]/text()")
-        )
-        parsed_fields["safety_review_date"] = process_extracted_text(
-            safety_rating_table.xpath("tr[2]/td[2]/text()")
-        )
-        parsed_fields["safety_rating"] = process_extracted_text(
-            safety_rating_table.xpath("tr[3]/td[1]/text()")
-        )
-        parsed_fields["safety_type"] = process_extracted_text(
-            safety_rating_table.xpath("tr[3]/td[2]/text()")
-        )
+        for name, path in SAFETY_RATING_FIELDS:
+            parsed_fields[name] = process_extracted_text(path(safety_rating_table[0]))
 
     # Parsing the latest update date.
-    parsed_fields["latest_update"] = process_extracted_text(
-        tree.xpath("//b/font[@color='#0000C0']/text()")[-1]
-    )
+    parsed_fields["latest_update"] = process_extracted_text(LATEST_UPDATE(tree)[-1])
 
     parsed_fields = process_final_dictionary(parsed_fields)
     return parsed_fields
@@ -0,0 +1,289 @@
+import re
+import sqlite3
+import threading
+
+# "CITY, ST" of a search result, or "STREET CITY, ST 12345" of a physical address
+LOCATION = re.compile(r"^\s*(.*?)\s*,\s*([A-Z]{2})\b")
+WHITESPACE = re.compile(r"\s+")
+# Docket numbers such as "MC-123456" in the MC/MX/FF Number(s) field of a snapshot
+DOCKET = re.compile(r"\b(MC|MX|FF)-(\d+)")
+# Prefixes of the dockets an MC/MX lookup matches, an FF docket with the same number is another docket
+MC_MX_PREFIXES = ("MC", "MX")
+
+
+def normalize_name(name):
+    """
+    :param name: Company name.
+    :return: The name uppercased with its whitespace collapsed, the way it's compared against queries.
+    """
+    return WHITESPACE.sub(" ", name).strip().upper() if name else ""
+
+
+def trigrams(text):
+    """
+    :param text: Normalized text.
+    :return: Set of every substring of three characters of the text.
+    """
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def parse_location(location):
+    """
+    Splits a location into the text before the state and the state.
+
+    :param location: "CITY, ST" of a search result or the physical address of a Company.
+    :return: (place, state) tuple, both uppercased, or (None, None) if the location isn't in either form.
+    """
+    match = LOCATION.match(location.upper()) if location else None
+    if match is None:
+        return None, None
+    return normalize_name(match.group(1)), match.group(2)
+
+
+def location_matches(place, state, city=None, state_filter=None):
+    """
+    :param place: Text before the state in a location, the city of a search result, or the street and city of an
+        address.
+    :param state: Two letter state of the location.
+    :param city: City to filter by, or None.
+    :param state_filter: Two letter state to filter by, or None.
+    :return: Whether the location is in the city and state.
+    """
+    if state_filter is not None and state != state_filter.upper():
+        return False
+    if city is not None:
+        city = normalize_name(city)
+        if not place or not (place == city or place.endswith(" " + city)):
+            return False
+    return True
+
+
+class LocalIndex:
+    """
+    In memory index of every Company and SearchResult the library has fetched, it answers name searches locally
+    without going to SAFER.
+
+    Legal and DBA names are indexed by their trigrams, so a query matches names that contain it anywhere, the same
+    way SAFER's "*NAME*" keyword search does. Results are never truncated.
+    """
+
+    def __init__(self):
+        self.__entries = {}
+        self.__postings = {}
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __add(self, usdot, names, replace_names, values, replace_location):
+        with self.__lock:
+            entry = self.__entries.get(usdot)
+            if entry is None:
+                entry = self.__entries[usdot] = {
+                    "name": None,
+                    "names": (),
+                    "location": None,
+                    "place": None,
+                    "state": None,
+                    "url": None,
+                }
+            old_names = entry["names"]
+            if not replace_names:
+                names = old_names + tuple(n for n in names if n not in old_names)
+            entry["names"] = names
+            if entry["name"] is None or replace_names:
+                entry["name"] = values["name"]
+            if entry["location"] is None or replace_location:
+                entry.update(location=values["location"], place=values["place"], state=values["state"])
+            if entry["url"] is None:
+                entry["url"] = values["url"]
+
+            old_grams = set().union(*(trigrams(n) for n in old_names))
+            new_grams = set().union(*(trigrams(n) for n in names))
+            for gram in old_grams - new_grams:
+                self.__postings[gram].discard(usdot)
+            for gram in new_grams - old_grams:
+                self.__postings.setdefault(gram, set()).add(usdot)
+
+    def add_search_result(self, result):
+        """
+        :param result: SearchResult
+        """
+        place, state = parse_location(result.location)
+        values = {"name": result.name, "location": result.location, "place": place, "state": state, "url": result.url}
+        # The city of a search result is more precise than the one found in an address, so it replaces it
+        self.__add(int(result.usdot), (normalize_name(result.name),), False, values, True)
+
+    def add_company(self, company):
+        """
+        :param company: Company
+        """
+        names = tuple(n for n in (normalize_name(company.legal_name), normalize_name(company.dba_name)) if n)
+        place, state = parse_location(company.physical_address)
+        values = {
+            "name": company.legal_name,
+            "location": "{}, {}".format(place, state) if state else None,
+            "place": place,
+            "state": state,
+            "url": company.url,
+        }
+        self.__add(int(company.usdot), names, True, values, False)
+
+    def add_search_results(self, results):
+        """
+        :param results: Iterable of SearchResults, such as a SearchResultSet.
+        """
+        for result in results:
+            self.add_search_result(result)
+
+    def __candidates(self, query):
+        grams = trigrams(query)
+        if not grams:
+            # Queries shorter than a trigram have to be compared against every name
+            return list(self.__entries)
+        postings = sorted((self.__postings.get(gram, set()) for gram in grams), key=len)
+        return set.intersection(*postings)
+
+    def search(self, name, state=None, city=None):
+        """
+        Finds the Companies whose legal or DBA name contains `name`.
+
+        :param name: A company name, or part of one.
+        :param state: Two letter state to filter by, or None.
+        :param city: City to filter by, or None.
+        :return: List of result dictionaries ordered by name, in the form SearchResultSet is built from.
+        """
+        query = normalize_name(name)
+        results = []
+        with self.__lock:
+            for usdot in self.__candidates(query):
+                entry = self.__entries[usdot]
+                if not any(query in n for n in entry["names"]):
+                    continue
+                if not location_matches(entry["place"], entry["state"], city, state):
+                    continue
+                results.append(
+                    {
+                        "id": str(usdot),
+                        "name": entry["name"],
+                        "location": entry["location"],
+                        "html": None,
+                        "url": entry["url"],
+                    }
+                )
+        results.sort(key=lambda r: (r["name"] or "", int(r["id"])))
+        return results
+
+
+def parse_dockets(mc_mx_ff_numbers):
+    """
+    :param mc_mx_ff_numbers: MC/MX/FF Number(s) field of a Company Snapshot, such as "MC-123456 FF-4321".
+    :return: List of (prefix, number) tuples, such as [("MC", 123456), ("FF", 4321)].
+    """
+    if not mc_mx_ff_numbers:
+        return []
+    return [(prefix, int(number)) for prefix, number in DOCKET.findall(mc_mx_ff_numbers.upper())]
+
+
+class DocketIndex:
+    """
+    Persistent index stored in a SQLite database from MC/MX/FF Numbers and DUNS Numbers to USDOT Numbers, and back.
+
+    It's filled from every Company the client it's set on returns, so an MC/MX lookup of a Company that was already
+    fetched can be resolved to its USDOT Number and served from the cache.
+    """
+
+    def __init__(self, path=":memory:"):
+        """
+        :param path: Path of the SQLite database file, it is created if it does not exist.
+        """
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        with self.__connection:
+            self.__connection.execute(
+                "CREATE TABLE IF NOT EXISTS dockets (prefix TEXT, number INTEGER, usdot INTEGER, "
+                "PRIMARY KEY (prefix, number))"
+            )
+            self.__connection.execute("CREATE INDEX IF NOT EXISTS dockets_usdot ON dockets (usdot)")
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS duns (duns TEXT PRIMARY KEY, usdot INTEGER)")
+            self.__connection.execute("CREATE INDEX IF NOT EXISTS duns_usdot ON duns (usdot)")
+
+    def add_company(self, company):
+        """
+        Replaces the docket and DUNS Numbers of the Company in the index with the ones it holds now.
+
+        :param company: Company
+        """
+        usdot = int(company.usdot)
+        dockets = parse_dockets(company.mc_mx_ff_numbers)
+        duns = company.duns_number.strip() if company.duns_number else None
+        with self.__lock, self.__connection:
+            self.__connection.execute("DELETE FROM dockets WHERE usdot = ?", (usdot,))
+            self.__connection.execute("DELETE FROM duns WHERE usdot = ?", (usdot,))
+            self.__connection.executemany(
+                "INSERT OR REPLACE INTO dockets (prefix, number, usdot) VALUES (?, ?, ?)",
+                [(prefix, number, usdot) for prefix, number in dockets],
+            )
+            if duns:
+                self.__connection.execute("INSERT OR REPLACE INTO duns (duns, usdot) VALUES (?, ?)", (duns, usdot))
+
+    def usdot_for_docket(self, prefix, number):
+        """
+        :param prefix: "MC", "MX" or "FF".
+        :param number: Docket number.
+        :return: USDOT Number of the Company that holds the docket, or None if it's not in the index.
+        """
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT usdot FROM dockets WHERE prefix = ? AND number = ?", (prefix.upper(), int(number))
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def usdot_for_mc_mx(self, number):
+        """
+        :param number: MC/MX Number, as given to CompanySnapshot.get_by_mc_mx_number.
+        :return: USDOT Number of the Company with that MC or MX Number, or None if it's not in the index.
+        """
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT usdot FROM dockets WHERE prefix IN ('MC', 'MX') AND number = ? ORDER BY prefix", (int(number),)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def usdot_for_duns(self, duns):
+        """
+        :param duns: DUNS Number.
+        :return: USDOT Number of the Company with that DUNS Number, or None if it's not in the index.
+        """
+        with self.__lock:
+            row = self.__connection.execute("SELECT usdot FROM duns WHERE duns = ?", (str(duns).strip(),)).fetchone()
+        return row[0] if row is not None else None
+
+    def dockets_for_usdot(self, usdot):
+        """
+        :param usdot: USDOT Number.
+        :return: List of the (prefix, number) tuples of the Company's dockets.
+        """
+        with self.__lock:
+            return [
+                tuple(row)
+                for row in self.__connection.execute(
+                    "SELECT prefix, number FROM dockets WHERE usdot = ? ORDER BY prefix, number", (int(usdot),)
+                )
+            ]
+
+    def duns_for_usdot(self, usdot):
+        """
+        :param usdot: USDOT Number.
+        :return: DUNS Number of the Company, or None if it's not in the index.
+        """
+        with self.__lock:
+            row = self.__connection.execute("SELECT duns FROM duns WHERE usdot = ?", (int(usdot),)).fetchone()
+        return row[0] if row is not None else None
+
+    def __len__(self):
+        with self.__lock:
+            return self.__connection.execute("SELECT COUNT(DISTINCT usdot) FROM dockets").fetchone()[0]
+
+    def close(self):
+        self.__connection.close()
@@ -0,0 +1,252 @@
+"""
+Hooks into the stages of a lookup, so the time spent on the network, in the HTML parser, in the extraction and in
+building the Company can be told apart.
+
+Subscribers are called with (event, value, attributes) for every event, see subscribe. The instrumented code checks
+`subscribers` before measuring anything, so with nothing subscribed it costs one attribute lookup per stage.
+"""
+import bisect
+import threading
+
+try:
+    from opentelemetry import metrics as otel_metrics
+except ImportError:
+    otel_metrics = None
+
+# Events, the value of the timed events is in seconds
+REQUEST_START = "request_start"
+REQUEST_END = "request_end"
+BYTES_RECEIVED = "bytes_received"
+PARSE = "parse"
+EXTRACT = "extract"
+BUILD = "build"
+CACHE_HIT = "cache_hit"
+CACHE_MISS = "cache_miss"
+CACHE_STALE_HIT = "cache_stale_hit"
+RETRY = "retry"
+
+TIMED_EVENTS = (REQUEST_END, PARSE, EXTRACT, BUILD)
+COUNTED_EVENTS = (REQUEST_START, BYTES_RECEIVED, CACHE_HIT, CACHE_MISS, CACHE_STALE_HIT, RETRY)
+
+DESCRIPTIONS = {
+    REQUEST_START: "Requests made to SAFER.",
+    REQUEST_END: "Seconds a request to SAFER took, retries and backoff included.",
+    BYTES_RECEIVED: "Bytes of the responses received from SAFER, once decoded.",
+    PARSE: "Seconds spent parsing pages into trees.",
+    EXTRACT: "Seconds spent extracting the values from the trees.",
+    BUILD: "Seconds spent building the Companies from the values.",
+    CACHE_HIT: "Fresh entries served from the cache.",
+    CACHE_MISS: "Lookups the cache had no fresh entry for.",
+    CACHE_STALE_HIT: "Expired entries served from the cache.",
+    RETRY: "Requests retried by the transport policy.",
+}
+
+# Attributes the events are emitted with, every one of them only takes a handful of values: the page that was parsed,
+# the type of query of a cache entry, the class of a status code, the type of an exception and the number of a retry
+ATTRIBUTES = ("page", "query_type", "status", "error", "failure", "attempt")
+
+# Upper bounds in seconds of the histogram buckets, from the page parsing to the slowest SAFER responses
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Replaced as a whole when subscribers are added or removed, so emit never has to lock
+subscribers = ()
+_subscribers_lock = threading.Lock()
+
+
+def subscribe(callback):
+    """
+    Subscribes a callback to every event. It's called in the thread the event happened in, with the name of the
+    event, its value, and a dictionary of attributes or None. It must be quick and must not raise.
+
+    :param callback: Callable taking (event, value, attributes), such as a HistogramCollector.
+    :return: The callback.
+    """
+    global subscribers  # pylint: disable=global-statement
+    with _subscribers_lock:
+        if callback not in subscribers:
+            subscribers = subscribers + (callback,)
+    return callback
+
+
+def unsubscribe(callback):
+    """
+    :param callback: Callback passed to subscribe.
+    """
+    global subscribers  # pylint: disable=global-statement
+    with _subscribers_lock:
+        subscribers = tuple(s for s in subscribers if s is not callback)
+
+
+def emit(event, value, attributes=None):
+    """
+    Calls the subscribers with an event, the callers check `subscribers` first so nothing is measured without them.
+
+    :param event: Name of the event.
+    :param value: Seconds for the timed events, a count or a number of bytes for the others.
+    :param attributes: Dictionary describing the event, or None.
+    """
+    for callback in subscribers:
+        callback(event, value, attributes)
+
+
+def status_class(status_code):
+    """
+    :param status_code: Status code of a response, such as 404.
+    :return: Its class, such as "4xx".
+    """
+    return "{}xx".format(status_code // 100)
+
+
+class Histogram:
+    """
+    Histogram of the values of a timed event, in fixed buckets.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # The last count is of the values above every bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Estimates a quantile by interpolating inside the bucket it falls in.
+
+        :param q: Quantile between 0 and 1, such as 0.99.
+        :return: Estimated value, or None if nothing was observed.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                if i == len(self.buckets):
+                    # Above the last bucket there is no upper bound to interpolate to
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class HistogramCollector:
+    """
+    In process collector of the events, a Histogram per timed event and a total per counted event. Subscribe it to
+    start collecting:
+
+        collector = subscribe(HistogramCollector())
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: Upper bounds in seconds of the histogram buckets.
+        """
+        self.buckets = tuple(buckets)
+        self.histograms = {event: Histogram(self.buckets) for event in TIMED_EVENTS}
+        self.counters = dict.fromkeys(COUNTED_EVENTS, 0)
+        self.__lock = threading.Lock()
+
+    def __call__(self, event, value, attributes=None):
+        with self.__lock:
+            histogram = self.histograms.get(event)
+            if histogram is not None:
+                histogram.observe(value)
+            else:
+                self.counters[event] = self.counters.get(event, 0) + value
+
+    def reset(self):
+        with self.__lock:
+            self.histograms = {event: Histogram(self.buckets) for event in TIMED_EVENTS}
+            self.counters = dict.fromkeys(COUNTED_EVENTS, 0)
+
+    def stats(self):
+        """
+        :return: Dictionary with the count, total, p50 and p99 of every timed event and the total of every counted
+            event.
+        """
+        with self.__lock:
+            stats = {
+                event: {
+                    "count": h.count,
+                    "sum": h.sum,
+                    "p50": h.quantile(0.5),
+                    "p99": h.quantile(0.99),
+                }
+                for event, h in self.histograms.items()
+            }
+            stats.update(self.counters)
+        return stats
+
+    def to_prometheus(self, prefix="safer"):
+        """
+        Exports the collected events in the Prometheus text exposition format, the timed events as histograms in
+        seconds and the counted events as counters.
+
+        :param prefix: Prefix of the metric names.
+        :return: String to serve on a /metrics endpoint.
+        """
+        lines = []
+        with self.__lock:
+            for event, h in self.histograms.items():
+                name = "{}_{}_seconds".format(prefix, event)
+                lines.append("# HELP {} {}".format(name, DESCRIPTIONS.get(event, event)))
+                lines.append("# TYPE {} histogram".format(name))
+                cumulative = 0
+                for bound, count in zip(self.buckets, h.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(name, repr(float(bound)), cumulative))
+                lines.append('{}_bucket{{le="+Inf"}} {}'.format(name, h.count))
+                lines.append("{}_sum {}".format(name, repr(h.sum)))
+                lines.append("{}_count {}".format(name, h.count))
+            for event, total in self.counters.items():
+                name = "{}_{}_total".format(prefix, event)
+                lines.append("# HELP {} {}".format(name, DESCRIPTIONS.get(event, event)))
+                lines.append("# TYPE {} counter".format(name))
+                lines.append("{} {}".format(name, total))
+        return "\n".join(lines) + "\n"
+
+
+class OpenTelemetryExporter:  # pylint: disable=too-few-public-methods
+    """
+    Records the events as OpenTelemetry metrics, the timed events as histograms in seconds and the counted events as
+    counters. Subscribe it like a HistogramCollector, the attributes of the events are passed along.
+
+    Every distinct set of attributes is a time series of its own, so only the attributes in ATTRIBUTES are passed
+    along, any other attribute a custom emitter adds is dropped.
+    """
+
+    def __init__(self, meter=None, prefix="safer"):
+        """
+        :param meter: opentelemetry.metrics.Meter to create the instruments with, the "safer" meter of the global
+            meter provider by default.
+        :param prefix: Prefix of the instrument names.
+        """
+        if otel_metrics is None:
+            raise ImportError(
+                "OpenTelemetryExporter requires opentelemetry-api, install it with 'pip install python-safer[otel]'"
+            )
+        meter = meter or otel_metrics.get_meter("safer")
+        self.__instruments = {}
+        for event in TIMED_EVENTS:
+            self.__instruments[event] = meter.create_histogram(
+                "{}.{}".format(prefix, event), unit="s", description=DESCRIPTIONS[event]
+            ).record
+        for event in COUNTED_EVENTS:
+            self.__instruments[event] = meter.create_counter(
+                "{}.{}".format(prefix, event), unit="By" if event == BYTES_RECEIVED else "1",
+                description=DESCRIPTIONS[event],
+            ).add
+
+    def __call__(self, event, value, attributes=None):
+        record = self.__instruments.get(event)
+        if record is not None:
+            if attributes:
+                attributes = {name: v for name, v in attributes.items() if name in ATTRIBUTES}
+            record(value, attributes=attributes)
@@ -0,0 +1,232 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from safer.api import get_client
+from safer.cache import cache_key, dump_company_record, load_company_record, response_validators
+from safer.crawler import PAGE_OK, parse_page
+from safer.exceptions import CompanySnapshotNotFoundException
+from safer.html import process_company_snapshot
+from safer.results import Company
+from safer.search import (
+    MC_MX_NOT_FOUND_MESSAGE,
+    USDOT_NOT_FOUND_MESSAGE,
+    content_hash,
+    raise_for_safer_status,
+    record_company,
+    request_company,
+    request_snapshot,
+)
+
+# Seconds a blocked thread waits before checking whether the pipeline was stopped
+POLL_INTERVAL = 0.1
+
+
+def parse_snapshot_page(content, encoding):
+    """
+    Parses a Company Snapshot page, it runs in the parser processes so only the parsed record is sent back.
+
+    :param content: Bytes of the page.
+    :param encoding: Encoding of the page, None to let lxml detect it.
+    :return: (dictionary of the Company Snapshot, content hash) tuple, or None if there are no results.
+    """
+    parsed = parse_page(content, encoding)
+    if parsed.state != PAGE_OK:
+        return None
+    return process_company_snapshot(parsed.tree), content_hash(content)
+
+
+def _put(items, item, stop):
+    """
+    Puts an item in a bounded queue, giving up if the pipeline is stopped while the queue is full.
+    """
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=POLL_INTERVAL)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+class ParsePipeline:
+    """
+    Gets many Company Snapshots with the fetching and the parsing split between threads and processes: a pool of
+    I/O threads requests the pages and a pool of parser processes parses them, so parsing isn't held back by the GIL
+    and scales with the number of cores.
+
+    Pages wait for a parser in a queue of `page_queue_depth` pages, once it's full the I/O threads stop fetching.
+    At most `parse_queue_depth` pages are being parsed or parsed and waiting to be read, once that many are the pages
+    stay in their queue. A consumer that reads slowly slows the whole pipeline down instead of piling up results.
+
+    Use it as a context manager, or call close() when done, so the parser processes are stopped. They are reused by
+    every call to get_many.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        io_workers=8,
+        parse_workers=None,
+        page_queue_depth=32,
+        parse_queue_depth=None,
+        client=None,
+    ):
+        """
+        :param io_workers: Number of threads that request pages.
+        :param parse_workers: Number of processes that parse pages, the number of CPUs by default.
+        :param page_queue_depth: Number of fetched pages that can wait for a parser.
+        :param parse_queue_depth: Number of pages that can be in the parser processes or parsed and waiting to be
+            read, twice the number of parser processes by default.
+        :param client: SaferClient to make the requests with, the default client if None.
+        """
+        if io_workers < 1 or page_queue_depth < 1:
+            raise ValueError("'io_workers' and 'page_queue_depth' must be at least 1")
+        self.io_workers = io_workers
+        self.parse_workers = parse_workers or os.cpu_count() or 1
+        self.page_queue_depth = page_queue_depth
+        self.parse_queue_depth = parse_queue_depth or 2 * self.parse_workers
+        self.client = client
+        self.__parsers = ProcessPoolExecutor(max_workers=self.parse_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.__parsers.shutdown(wait=True, cancel_futures=True)
+
+    def __fetch(self, query_type, number):
+        """
+        Gets a page the way CompanySnapshot does, only the parsing is left to the parser processes.
+
+        :return: Company of a cached record, or (bytes, encoding, validators) tuple of the page.
+        """
+        client = get_client(self.client)
+        cache = client.company_cache()
+        key = cache_key("company:" + query_type, number)
+        get = client.get_usdot if query_type == "usdot" else client.get_mcmx
+        if cache is not None:
+            entry = cache.get_entry(key, decode=load_company_record)
+            if entry is not None:
+                return record_company(*entry)
+            entry = client.stale_entry(key, decode=load_company_record)
+            if entry is not None:
+                message = USDOT_NOT_FOUND_MESSAGE if query_type == "usdot" else MC_MX_NOT_FOUND_MESSAGE
+                client.revalidate_in_background(
+                    key,
+                    lambda: request_company(
+                        query_type, number, lambda: get(number, conditional=True), message, client=client
+                    ),
+                )
+                return record_company(*entry, stale=True)
+
+        r = request_snapshot(cache, key, lambda: get(number, conditional=True))
+        if isinstance(r, Company):
+            return r
+        raise_for_safer_status(r.status_code, r.reason)
+        return r.content, r.encoding, response_validators(r.headers) if cache is not None else None
+
+    def __fetch_pages(self, next_job, pages, stop):
+        while not stop.is_set():
+            key = next_job()
+            if key is None:
+                break
+            try:
+                item = self.__fetch(*key)
+            except Exception as e:  # pylint: disable=broad-except
+                item = e
+            if not _put(pages, (key, item), stop):
+                break
+
+    def __submit_pages(self, total, pages, slots, results, stop):
+        for _ in range(total):
+            key = item = None
+            while not stop.is_set():
+                try:
+                    key, item = pages.get(timeout=POLL_INTERVAL)
+                    break
+                except queue.Empty:
+                    continue
+            while not stop.is_set() and not slots.acquire(timeout=POLL_INTERVAL):
+                continue
+            if stop.is_set():
+                return
+            if not isinstance(item, tuple):
+                results.put((key, item))
+                continue
+            content, encoding, validators = item
+            try:
+                future = self.__parsers.submit(parse_snapshot_page, content, encoding)
+            except Exception as e:  # pylint: disable=broad-except
+                results.put((key, e))
+            else:
+                future.add_done_callback(lambda f, key=key, validators=validators: results.put((key, (f, validators))))
+
+    def __build(self, key, item):
+        query_type, number = key
+        if isinstance(item, Exception):
+            return item
+        if isinstance(item, Company):
+            return get_client(self.client).index_company(item)
+
+        future, validators = item
+        exception = future.exception()
+        if exception is not None:
+            return exception
+        parsed = future.result()
+        if parsed is None:
+            message = USDOT_NOT_FOUND_MESSAGE if query_type == "usdot" else MC_MX_NOT_FOUND_MESSAGE
+            return CompanySnapshotNotFoundException(message)
+        data, page_hash = parsed
+        company = Company(data=data, content_hash=page_hash, fetched_at=time.time())
+        client = get_client(self.client)
+        cache = client.company_cache()
+        if cache is not None:
+            cache.set(
+                cache_key("company:" + query_type, number),
+                dump_company_record(company.to_dict(), company.content_hash, validators),
+            )
+        return client.index_company(company)
+
+    def get_many(self, usdots=(), mc_mx=()):
+        """
+        Gets the Company Snapshots of many USDOT and/or MC/MX Numbers.
+
+        Results are yielded in the order they complete as (key, result) tuples like CompanySnapshot.get_many. The
+        key is ("usdot", number) or ("mc_mx", number), the result is a Company or the exception raised while getting
+        it.
+
+        :param usdots: Iterable of USDOT Numbers.
+        :param mc_mx: Iterable of MC/MX Numbers.
+        :return: Generator of (key, Company or Exception) tuples.
+        """
+        keys = [("usdot", number) for number in usdots] + [("mc_mx", number) for number in mc_mx]
+        jobs = iter(keys)
+        jobs_lock = threading.Lock()
+
+        def next_job():
+            with jobs_lock:
+                return next(jobs, None)
+
+        pages = queue.Queue(maxsize=self.page_queue_depth)
+        results = queue.Queue()
+        slots = threading.Semaphore(self.parse_queue_depth)
+        stop = threading.Event()
+
+        get_client(self.client).ensure_pool_size(self.io_workers)
+        threads = ThreadPoolExecutor(max_workers=self.io_workers + 1)
+        try:
+            for _ in range(self.io_workers):
+                threads.submit(self.__fetch_pages, next_job, pages, stop)
+            threads.submit(self.__submit_pages, len(keys), pages, slots, results, stop)
+            for _ in range(len(keys)):
+                key, item = results.get()
+                slots.release()
+                yield key, self.__build(key, item)
+        finally:
+            # Unblocks the threads if the caller stopped iterating early
+            stop.set()
+            threads.shutdown(wait=True)
@@ -0,0 +1,184 @@
+import random
+import threading
+import time
+from requests.exceptions import ConnectionError as RequestsConnectionError, Timeout
+from safer import instrumentation
+from safer.exceptions import SAFERUnreachableException
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter that adapts its rate, every failure halves the rate down to `min_rate` and every
+    success raises it again step by step up to `rate`.
+    """
+
+    def __init__(self, rate, burst=1, min_rate=None):
+        """
+        :param rate: Requests per second allowed when SAFER is healthy.
+        :param burst: Number of requests that can be made at once after being idle.
+        :param min_rate: Lowest rate the limiter slows down to, defaults to a tenth of `rate`.
+        """
+        if rate <= 0:
+            raise ValueError("'rate' must be greater than 0")
+        self.max_rate = rate
+        self.min_rate = min_rate if min_rate is not None else rate / 10
+        self.rate = rate
+        self.burst = burst
+        self.__tokens = burst
+        self.__updated_at = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token, blocking until one is available.
+        """
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.burst, self.__tokens + (now - self.__updated_at) * self.rate)
+            self.__updated_at = now
+            # Tokens can go negative, that reserves the next token for this caller
+            self.__tokens -= 1
+            wait = -self.__tokens / self.rate if self.__tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def slow_down(self):
+        with self.__lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def speed_up(self):
+        with self.__lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker that opens after `failure_threshold` failures in a row, while it's open requests are refused.
+    After `reset_timeout` seconds a single trial request is let through, the breaker closes again if it succeeds.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.__opened_at = 0.0
+        self.__lock = threading.Lock()
+
+    def allow(self):
+        """
+        :return: Whether a request may be made.
+        """
+        with self.__lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if self.state == CircuitBreaker.OPEN and time.monotonic() - self.__opened_at >= self.reset_timeout:
+                self.state = CircuitBreaker.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self.__lock:
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.__lock:
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = CircuitBreaker.OPEN
+                self.__opened_at = time.monotonic()
+
+
+class TransportPolicy:
+    """
+    Policy applied to every request to SAFER: requests are rate limited, retried with exponential backoff and jitter
+    on 5xx responses and timeouts, and refused right away while the circuit breaker is open.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        *,
+        rate=5.0,
+        burst=5,
+        max_retries=3,
+        backoff_base=0.5,
+        backoff_max=30.0,
+        failure_threshold=5,
+        reset_timeout=30.0,
+    ):
+        """
+        :param rate: Requests per second, None to not rate limit.
+        :param burst: Number of requests that can be made at once after being idle.
+        :param max_retries: Number of times a failed request is retried.
+        :param backoff_base: Seconds of the backoff after the first failure, it doubles with every retry.
+        :param backoff_max: Maximum seconds of a backoff.
+        :param failure_threshold: Number of failures in a row that open the circuit breaker.
+        :param reset_timeout: Seconds the circuit breaker stays open before a trial request is let through.
+        """
+        self.rate_limiter = TokenBucket(rate, burst) if rate else None
+        self.circuit_breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def backoff(self, attempt):
+        """
+        :param attempt: Number of the attempt that failed, starting at 0.
+        :return: Seconds to wait before the next attempt, with full jitter.
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def execute(self, call):
+        """
+        Makes a request under this policy.
+
+        :param call: Function without arguments that makes the request.
+        :return: requests.Response with a status code below 500.
+        :raises SAFERUnreachableException: If the circuit breaker is open or every attempt failed.
+        """
+        failure = None
+        for attempt in range(self.max_retries + 1):
+            if not self.circuit_breaker.allow():
+                raise SAFERUnreachableException(
+                    "The SAFER website is currently unreachable, requests are paused after {} failures".format(
+                        self.circuit_breaker.failures
+                    )
+                )
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            try:
+                r = call()
+            except (Timeout, RequestsConnectionError) as e:
+                failure = "{}: {}".format(type(e).__name__, e)
+                failure_type = type(e).__name__
+            except BaseException:
+                # Not retried, but still a failure so a trial request always takes the breaker out of half open
+                self.circuit_breaker.record_failure()
+                raise
+            else:
+                if r.status_code < 500:
+                    self.circuit_breaker.record_success()
+                    if self.rate_limiter is not None:
+                        self.rate_limiter.speed_up()
+                    return r
+                failure = "status code: {} {}".format(r.status_code, r.reason)
+                failure_type = instrumentation.status_class(r.status_code)
+                r.close()
+
+            self.circuit_breaker.record_failure()
+            if self.rate_limiter is not None:
+                self.rate_limiter.slow_down()
+            if attempt < self.max_retries:
+                if instrumentation.subscribers:
+                    instrumentation.emit(instrumentation.RETRY, 1, {"attempt": attempt + 1, "failure": failure_type})
+                time.sleep(self.backoff(attempt))
+
+        raise SAFERUnreachableException(
+            "The SAFER website is currently unreachable with {}".format(failure)
+        )
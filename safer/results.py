@@ -1,225 +1,296 @@
 import re
+import time
+from collections import namedtuple
 from datetime import datetime
 from json import dumps
 from webbrowser import open as open_browser
 from dateutil import parser
-from safer.api import api_call_get_usdot
-from safer.crawler import parse_html_to_tree
-from safer.html import process_company_snapshot
+from lxml import html
+from safer.html import remove_unwanted_characters
+
+
+US_DATE = re.compile(r"(\d{1,2})/(\d{1,2})/(\d{4})$")
+
+# Marks a date that hasn't been parsed yet
+NOT_PARSED = object()
+
+
+def parse_us_date(value):
+    return datetime.strptime(value, "%m/%d/%Y") if value else None
+
+
+def parse_any_date(value):
+    if not value:
+        return None
+    # SAFER's dates are almost always MM/DD/YYYY, dateutil is only needed for anything else
+    match = US_DATE.match(value)
+    if match is not None:
+        month, day, year = match.groups()
+        return datetime(int(year), int(month), int(day))
+    return parser.parse(value)
+
+
+# A field of a Company that changed, nested fields are named by their path such as "us_inspections.driver.inspections"
+FieldChange = namedtuple("FieldChange", ["field", "old", "new"])
+# The changes found in a Company when it was refreshed, `error` is the exception raised if it couldn't be refreshed
+CompanyDiff = namedtuple("CompanyDiff", ["usdot", "company", "changes", "error"])
+
+
+def diff_fields(old, new, prefix=""):
+    """
+    Compares the dictionaries of two Companies field by field.
+
+    :param old: Dictionary of the stored Company.
+    :param new: Dictionary of the refreshed Company.
+    :param prefix: Path of the dictionaries inside the Company, used for nested fields.
+    :return: List of FieldChanges.
+    """
+    changes = []
+    for key in list(old) + [k for k in new if k not in old]:
+        old_value, new_value = old.get(key), new.get(key)
+        if old_value == new_value:
+            continue
+        if isinstance(old_value, dict) and isinstance(new_value, dict):
+            changes += diff_fields(old_value, new_value, prefix + key + ".")
+        else:
+            changes.append(FieldChange(prefix + key, old_value, new_value))
+    return changes
 
 
 class Company:
     """
     Company Object Representation of a Company Snapshot from the SAFER website.
+
+    The values are read straight from the dictionary the Company is built from, which is shared rather than copied,
+    and the dates are only parsed the first time they are accessed.
     """
 
-    def __init__(self, data):
+    # The dates are NOT_PARSED until their first access.
+    __slots__ = (
+        "__raw",
+        "__latest_update",
+        "__safety_rating_date",
+        "__safety_review_date",
+        "__mcs_150_form_date",
+        "__out_of_service_date",
+        "__content_hash",
+        "__fetched_at",
+        "__stale",
+    )
+
+    def __init__(self, data, content_hash=None, fetched_at=None, stale=False):
         """
         Initializes data coming from the web scraper.
 
         :param data: Dictionary of values that have been scraped from the CompanySnapshot website.
+        :param content_hash: Hash of the page the Company was parsed from, used by refresh to skip unchanged pages.
+        :param fetched_at: Time in seconds since the epoch the page was fetched from SAFER, None if it's unknown.
+        :param stale: Whether the Company was served from an expired cache entry.
         """
 
-        # Mapping values.
-        self.__entity_type = data["entity_type"]
-        self.__operating_authority_status = data["operating_authority_status"]
-        self.__legal_name = data["legal_name"]
-        self.__dba_name = data["dba_name"]
-        self.__duns_number = data["duns_number"]
-        self.__state_carrier_id = data["state_carrier_id"]
-        self.__mailing_address = data["mailing_address"]
-        self.__physical_address = data["physical_address"]
-        self.__carrier_operation = data["carrier_operation"]
-        self.__hm_shipper_operation = data["hm_shipper_operation"]
-        self.__mcs_150_mileage_year = data["mcs_150_mileage_year"]
-        self.__mc_mx_ff_numbers = data["mc_mx_ff_numbers"]
-        self.__operation_classification = data["operation_classification"]
-        self.__power_units = data["power_units"]
-        self.__drivers = data["drivers"]
-        self.__usdot = data["usdot"]
-        self.__phone_number = data["phone"]
-        self.__safety_rating = data["safety_rating"]
-        self.__safety_type = data["safety_type"]
-        self.__united_states_inspections = data["united_states_inspections"]
-        self.__united_states_crashes = data["united_states_crashes"]
-        self.__canada_inspections = data["canada_inspections"]
-        self.__canada_crashes = data["canada_crashes"]
-        self.__cargo_carried = data["cargo_carried"]
-
-        # Parsing date strings as datetime objects
-        self.__latest_update = (
-            datetime.strptime(data["latest_update"], "%m/%d/%Y")
-            if data["latest_update"]
-            else None
-        )
-        self.__safety_rating_date = (
-            datetime.strptime(data["safety_review_date"], "%m/%d/%Y")
-            if data["safety_review_date"]
-            else None
-        )
-        self.__safety_review_date = (
-            parser.parse(data["safety_review_date"])
-            if data["safety_review_date"]
-            else None
-        )
-        self.__mcs_150_form_date = (
-            parser.parse(data["mcs_150_form_date"])
-            if data["mcs_150_form_date"]
-            else None
-        )
-        self.__out_of_service_date = (
-            parser.parse(data["out_of_service_date"])
-            if data["out_of_service_date"]
-            else None
-        )
-
-        # Keeping the raw dictionary for dumping to JSON if needed.
+        # Keeping the raw dictionary for the values and for dumping to JSON if needed.
         self.__raw = data
+        self.__content_hash = content_hash
+        self.__fetched_at = fetched_at
+        self.__stale = stale
+        self.__latest_update = NOT_PARSED
+        self.__safety_rating_date = NOT_PARSED
+        self.__safety_review_date = NOT_PARSED
+        self.__mcs_150_form_date = NOT_PARSED
+        self.__out_of_service_date = NOT_PARSED
 
         # Building a url for this Company
         # pylint: disable-next=line-too-long
-        self.__url = "http://safer.fmcsa.dot.gov/query.asp?searchtype=ANY&query_type=queryCarrierSnapshot&query_param=USDOT&original_query_param=NAME&query_string={}".format(
-            self.__usdot
+        self.__raw["url"] = "http://safer.fmcsa.dot.gov/query.asp?searchtype=ANY&query_type=queryCarrierSnapshot&query_param=USDOT&original_query_param=NAME&query_string={}".format(
+            data["usdot"]
         )
-        self.__raw["url"] = self.__url
+
+    @property
+    def operating_authority_status(self):
+        return self.__raw["operating_authority_status"]
 
     @property
     def operating_authority_status_status(self):
-        return self.__operating_authority_status
+        """
+        Old name of operating_authority_status, kept for compatibility.
+        """
+        return self.operating_authority_status
 
     @property
-    def safety_review_data(self):
+    def safety_review_date(self):
+        if self.__safety_review_date is NOT_PARSED:
+            self.__safety_review_date = parse_any_date(self.__raw["safety_review_date"])
         return self.__safety_review_date
 
+    @property
+    def safety_review_data(self):
+        """
+        Old name of safety_review_date, kept for compatibility.
+        """
+        return self.safety_review_date
+
     @property
     def safety_rating_date(self):
+        if self.__safety_rating_date is NOT_PARSED:
+            self.__safety_rating_date = parse_us_date(self.__raw["safety_review_date"])
         return self.__safety_rating_date
 
     @property
     def safety_rating(self):
-        return self.__safety_rating
+        return self.__raw["safety_rating"]
 
     @property
     def safety_type(self):
-        return self.__safety_type
+        return self.__raw["safety_type"]
 
     @property
     def mcs_150_mileage_year(self):
-        return self.__mcs_150_mileage_year
+        return self.__raw["mcs_150_mileage_year"]
 
     @property
     def phone_number(self):
-        return self.__phone_number
+        return self.__raw["phone"]
 
     @property
     def cargo_carried(self):
-        return self.__cargo_carried
+        return self.__raw["cargo_carried"]
 
     @property
     def canada_inspections(self):
-        return self.__canada_inspections
+        return self.__raw["canada_inspections"]
 
     @property
     def canada_crashes(self):
-        return self.__canada_crashes
+        return self.__raw["canada_crashes"]
 
     @property
     def usdot(self):
-        return self.__usdot
+        return self.__raw["usdot"]
 
     @property
     def drivers(self):
-        return self.__drivers
+        return self.__raw["drivers"]
 
     @property
     def power_units(self):
-        return self.__power_units
+        return self.__raw["power_units"]
 
     @property
     def united_states_crashes(self):
-        return self.__united_states_crashes
+        return self.__raw["united_states_crashes"]
 
     @property
     def united_states_inspections(self):
-        return self.__united_states_inspections
+        return self.__raw["united_states_inspections"]
 
     @property
     def operation_classification(self):
-        return self.__operation_classification
+        return self.__raw["operation_classification"]
 
     @property
     def mc_mx_ff_numbers(self):
-        return self.__mc_mx_ff_numbers
+        return self.__raw["mc_mx_ff_numbers"]
 
     @property
     def mcs_150_form_date(self):
+        if self.__mcs_150_form_date is NOT_PARSED:
+            self.__mcs_150_form_date = parse_any_date(self.__raw["mcs_150_form_date"])
         return self.__mcs_150_form_date
 
     @property
     def carrier_operation(self):
-        return self.__carrier_operation
+        return self.__raw["carrier_operation"]
 
     @property
     def hm_shipper_operation(self):
-        return self.__hm_shipper_operation
+        return self.__raw["hm_shipper_operation"]
 
     @property
     def mailing_address(self):
-        return self.__mailing_address
+        return self.__raw["mailing_address"]
 
     @property
     def physical_address(self):
-        return self.__physical_address
+        return self.__raw["physical_address"]
 
     @property
     def entity_type(self):
-        return self.__entity_type
+        return self.__raw["entity_type"]
 
     @property
     def operating_type(self):
-        return self.__entity_type
+        return self.__raw["entity_type"]
 
     @property
     def out_of_service_date(self):
+        if self.__out_of_service_date is NOT_PARSED:
+            self.__out_of_service_date = parse_any_date(self.__raw["out_of_service_date"])
         return self.__out_of_service_date
 
     @property
     def legal_name(self):
-        return self.__legal_name
+        return self.__raw["legal_name"]
 
     @property
     def dba_name(self):
-        return self.__dba_name
+        return self.__raw["dba_name"]
 
     @property
     def duns_number(self):
-        return self.__duns_number
+        return self.__raw["duns_number"]
 
     @property
     def latest_update(self):
+        if self.__latest_update is NOT_PARSED:
+            self.__latest_update = parse_us_date(self.__raw["latest_update"])
         return self.__latest_update
 
     @property
     def state_carrier_id(self):
-        return self.__state_carrier_id
+        return self.__raw["state_carrier_id"]
 
     @property
     def url(self):
-        return self.__url
+        return self.__raw["url"]
+
+    @property
+    def content_hash(self):
+        return self.__content_hash
+
+    @property
+    def fetched_at(self):
+        return self.__fetched_at
+
+    @property
+    def age(self):
+        """
+        :return: Seconds since the page the Company was parsed from was fetched, None if it's unknown.
+        """
+        if self.__fetched_at is None:
+            return None
+        return max(0.0, time.time() - self.__fetched_at)
+
+    @property
+    def is_stale(self):
+        """
+        :return: Whether the Company was served from an expired cache entry, because it was being revalidated in the
+            background or because SAFER was unreachable.
+        """
+        return self.__stale
 
     def __eq__(self, other):
         """
         Compares two Companies
         """
-        return self.__usdot == other.usdot
+        return self.usdot == other.usdot
 
     def __str__(self):
         return "<Company {} ({}) from {}>".format(
-            self.__legal_name, self.__usdot, self.__physical_address
+            self.legal_name, self.usdot, self.physical_address
         )
 
     def __repr__(self):
-        return "Company({})".format(self.__usdot)
+        return "Company({})".format(self.usdot)
 
     def to_json(self):
         return dumps(self.__raw)
@@ -228,7 +299,7 @@ class Company:
         return self.__raw
 
     def open_url(self):
-        open_browser(self.__url)
+        open_browser(self.url)
 
 
 class SearchResult:
@@ -258,7 +329,15 @@ class SearchResult:
 
     @property
     def raw_html(self):
-        return re.sub("[\n\t\r\xa0]+", "", self.__result_raw_html)
+        # Results from the local index have no HTML
+        if self.__result_raw_html is None:
+            return None
+        # The row is only serialized the first time it's needed, most callers never read it.
+        if not isinstance(self.__result_raw_html, str):
+            self.__result_raw_html = remove_unwanted_characters(
+                html.tostring(self.__result_raw_html, pretty_print=True, encoding="unicode")
+            )
+        return remove_unwanted_characters(self.__result_raw_html)
 
     @property
     def url(self):
@@ -278,14 +357,17 @@ class SearchResult:
     def __repr__(self):
         return "SearchResult({})".format(self.__result_id)
 
-    def get_company_snapshot(self):
+    def get_company_snapshot(self, client=None):
         """
         Uses the __result_id value to get the rest of the company data.
 
+        :param client: SaferClient to make the request with, the default client if None.
         :return: Company Class representing the full company data
         """
-        r = api_call_get_usdot(self.__result_id)
-        return Company(data=process_company_snapshot(parse_html_to_tree(r.text)))
+        # pylint: disable-next=import-outside-toplevel,cyclic-import
+        from safer.search import CompanySnapshot
+
+        return CompanySnapshot.get_by_usdot_number(int(self.__result_id), client=client)
 
 
 class SearchResultSet:
@@ -293,11 +375,17 @@ class SearchResultSet:
     Object representing a list of results, used mainly to iterate through the results.
     """
 
-    def __init__(self, results, search_query):
+    def __init__(self, results, search_query, truncated=None):
+        """
+        :param results: List of result dictionaries.
+        :param search_query: The name that was searched for.
+        :param truncated: Whether SAFER cut the results short, by default it's assumed it did when there are more than
+            500 results.
+        """
         self.__search_results = [SearchResult(x) for x in results]
         self.__index = -1
         self.__search_query = search_query
-        self.__truncated = len(results) > 500
+        self.__truncated = len(results) > 500 if truncated is None else truncated
         self.__total_results = len(results)
 
     @property
@@ -325,3 +413,25 @@ class SearchResultSet:
         if self.__index == len(self.__search_results):
             raise StopIteration
         return self.__search_results[self.__index]
+
+    def get_company_snapshots(self, concurrency=8, filter=None, client=None):  # pylint: disable=redefined-builtin
+        """
+        Gets the Company Snapshots of the results concurrently, each USDOT Number is only requested once even if
+        it's listed more than once.
+
+        :param concurrency: Number of snapshots to request at the same time.
+        :param filter: Optional function that takes a SearchResult and returns whether to get its snapshot.
+        :param client: SaferClient to make the requests with, the default client if None.
+        :return: List of (SearchResult, Company or Exception) tuples in the order of the results, a failed snapshot
+            is returned as the exception that was raised instead of being raised.
+        """
+        # pylint: disable-next=import-outside-toplevel,cyclic-import
+        from safer.search import CompanySnapshot
+
+        results = [x for x in self.__search_results if filter is None or filter(x)]
+        usdots = list(dict.fromkeys(int(x.usdot) for x in results))
+        snapshots = {
+            key[1]: snapshot
+            for key, snapshot in CompanySnapshot.get_many(usdots=usdots, max_workers=concurrency, client=client)
+        }
+        return [(x, snapshots[int(x.usdot)]) for x in results]
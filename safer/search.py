@@ -1,97 +1,508 @@
-from safer.api import api_call_search, api_call_get_usdot, api_call_get_mcmx
-from safer.crawler import parse_html_to_tree
-from safer.html import process_search_result_html, process_company_snapshot
-from safer.results import Company, SearchResultSet
+import copy
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from safer.api import (
+    UNREACHABLE_ERRORS,
+    api_call_search,
+    api_call_search_stream,
+    api_call_get_usdot,
+    api_call_get_mcmx,
+    get_client,
+)
+from safer import instrumentation
+from safer.cache import cache_key, dump_company_record, load_company_record, response_validators
+from safer.crawler import PAGE_OK, parse_page
+from safer.html import process_search_result_html, iter_search_result_html, process_company_snapshot, find_latest_update
+from safer.index import MC_MX_PREFIXES, location_matches, parse_dockets, parse_location
+from safer.results import Company, CompanyDiff, SearchResult, SearchResultSet, diff_fields
 from safer.exceptions import CompanySnapshotNotFoundException, SAFERUnreachableException
 
+USDOT_NOT_FOUND_MESSAGE = "The USDOT number provided was not found."
+MC_MX_NOT_FOUND_MESSAGE = "The MC or MX number you provided was not found."
+
+
+def raise_for_safer_status(status_code, reason):
+    """
+    Raises SAFERUnreachableException if SAFER responded with an error status code.
+
+    :param status_code: HTTP status code of the response.
+    :param reason: HTTP reason phrase of the response.
+    """
+    if status_code > 399:
+        raise SAFERUnreachableException(
+            "The SAFER website is currently unreachable with status code: {} {}".format(
+                status_code, reason
+            )
+        )
+
+
+def build_search_result_set(page, name, state=None, city=None, encoding=None):  # pylint: disable=too-many-arguments
+    """
+    Parses the HTML of a keyword search into a SearchResultSet.
+
+    :param page: Bytes or string of html returned by the keyword search.
+    :param name: The name that was searched for.
+    :param state: Two letter state to filter the results by, or None.
+    :param city: City to filter the results by, or None.
+    :param encoding: Encoding of the bytes, None to let lxml detect it.
+    :return: SearchResultSet Class with multiple SearchResults.
+    """
+    # Parse HTML result to tree
+    parsed = parse_page(page, encoding)
+    if parsed.state != PAGE_OK:
+        # No results, or an empty page, is an empty result set
+        return SearchResultSet([], name)
+    # Parse out values from HTML tree
+    start = time.perf_counter() if instrumentation.subscribers else None
+    search_results = process_search_result_html(parsed.tree)
+    if start is not None:
+        instrumentation.emit(instrumentation.EXTRACT, time.perf_counter() - start, {"page": "search"})
+    if state is None and city is None:
+        return SearchResultSet(search_results, name)
+    truncated = len(search_results) > 500
+    search_results = [x for x in search_results if location_matches(*parse_location(x["location"]), city, state)]
+    return SearchResultSet(search_results, name, truncated=truncated)
+
+
+def build_company(  # pylint: disable=too-many-arguments
+    page, not_found_message, encoding=None, fetched_at=None, stale=False
+):
+    """
+    Parses the HTML of a Company Snapshot into a Company.
+
+    :param page: Bytes or string of html returned by the snapshot query.
+    :param not_found_message: Message of the exception raised when there are no results.
+    :param encoding: Encoding of the bytes, None to let lxml detect it.
+    :param fetched_at: Time in seconds since the epoch the page was fetched, now if None.
+    :param stale: Whether the page was served from an expired cache entry.
+    :return: Company Class.
+    """
+    # Parse HTML result to tree
+    parsed = parse_page(page, encoding)
+    if parsed.state != PAGE_OK:
+        # No records, or an empty page, means the Company wasn't found
+        raise CompanySnapshotNotFoundException(not_found_message)
+    # Parse out values from HTML tree
+    start = time.perf_counter() if instrumentation.subscribers else None
+    search_results = process_company_snapshot(parsed.tree)
+    if start is not None:
+        extracted = time.perf_counter()
+        instrumentation.emit(instrumentation.EXTRACT, extracted - start, {"page": "snapshot"})
+    company = Company(
+        data=search_results,
+        content_hash=content_hash(page),
+        fetched_at=fetched_at if fetched_at is not None else time.time(),
+        stale=stale,
+    )
+    if start is not None:
+        instrumentation.emit(instrumentation.BUILD, time.perf_counter() - extracted)
+    return company
+
+
+def content_hash(page):
+    """
+    :param page: Bytes or string of html of a Company Snapshot, strings are hashed as UTF-8.
+    :return: Hex digest of the page.
+    """
+    if isinstance(page, str):
+        page = page.encode("utf-8")
+    return hashlib.blake2b(page, digest_size=16).hexdigest()
+
+
+def refresh_company(company, client=None):
+    """
+    Requests the snapshot of a Company again and compares it with the Company. The page is only parsed if it changed:
+    either its content hash differs from the one of the page the Company was parsed from, or, when that isn't known,
+    its "latest update" date differs. The request is always made, conditional on the validators of what the cache
+    holds, even if it holds a fresh entry. When SAFER answers 304, the Company is compared with the cached page or
+    record, since the Company may be older than it.
+
+    :param company: Company Class that was fetched before.
+    :param client: SaferClient to make the request with, the default client if None.
+    :return: CompanyDiff of the refreshed Company, or None if nothing changed.
+    """
+    usdot = int(company.usdot)
+    client = get_client(client)
+    cache = client.company_cache()
+    key = cache_key("company:usdot", usdot)
+    # Never served from a fresh cache entry, SAFER is always asked whether the page changed
+    r = api_call_get_usdot(usdot, client=client, revalidate=True)
+    if r.status_code == 304:
+        # SAFER confirmed the page of the record in the cache is unchanged, which might be newer than the Company
+        value = cache.revalidate(key) if cache is not None else None
+        record = load_company_record(value) if value is not None else None
+        if record is not None:
+            if record.content_hash is not None and record.content_hash == company.content_hash:
+                return None
+            refreshed = client.index_company(record_company(record, time.time()))
+            changes = diff_fields(company.to_dict(), refreshed.to_dict())
+            return CompanyDiff(usdot, refreshed, changes, None) if changes else None
+        # The record was evicted since the request was made, without it the request isn't conditional
+        r = api_call_get_usdot(usdot, client=client)
+    raise_for_safer_status(r.status_code, r.reason)
+    content = r.content
+
+    page_hash = content_hash(content)
+    if page_hash == company.content_hash:
+        return None
+    latest_update = company.to_dict().get("latest_update")
+    if company.content_hash is None and latest_update is not None and find_latest_update(content) == latest_update:
+        return None
+
+    refreshed = build_company(content, USDOT_NOT_FOUND_MESSAGE, encoding=r.encoding)
+    if cache is not None:
+        cache.set(
+            key,
+            dump_company_record(refreshed.to_dict(), refreshed.content_hash, response_validators(r.headers)),
+        )
+    client.index_company(refreshed)
+
+    changes = diff_fields(company.to_dict(), refreshed.to_dict())
+    return CompanyDiff(usdot, refreshed, changes, None) if changes else None
+
+
+def fetch_company(query_type, number, call, not_found_message, client=None):
+    """
+    Gets a Company from the cache of parsed records if there is one, otherwise requests and parses its snapshot and
+    stores the parsed record in that cache. An expired record is revalidated with a conditional request and used
+    again if the page is unchanged, or under stale_while_revalidate it's used right away and revalidated in the
+    background. If SAFER is unreachable an expired record is used when there is one.
+
+    :param query_type: Type of the query, "usdot" or "mc_mx".
+    :param number: USDOT Number or MC/MX Number.
+    :param call: Function without arguments that requests the snapshot.
+    :param not_found_message: Message of the exception raised when there are no results.
+    :param client: SaferClient whose cache is used, the default client if None.
+    :return: Company Class.
+    """
+    client = get_client(client)
+    cache = client.company_cache()
+    key = cache_key("company:" + query_type, number)
+    if cache is not None:
+        entry = cache.get_entry(key, decode=load_company_record)
+        if entry is not None:
+            return client.index_company(record_company(*entry))
+        entry = client.stale_entry(key, decode=load_company_record)
+        if entry is not None:
+            client.revalidate_in_background(
+                key, lambda: request_company(query_type, number, call, not_found_message, client=client)
+            )
+            return client.index_company(record_company(*entry, stale=True))
+    return request_company(query_type, number, call, not_found_message, client=client)
+
+
+def request_company(query_type, number, call, not_found_message, client=None):
+    """
+    Requests and parses the snapshot of a Company and stores the parsed record in the cache of parsed records, if
+    there is one, see fetch_company.
+
+    :param query_type: Type of the query, "usdot" or "mc_mx".
+    :param number: USDOT Number or MC/MX Number.
+    :param call: Function without arguments that requests the snapshot.
+    :param not_found_message: Message of the exception raised when there are no results.
+    :param client: SaferClient whose cache is used, the default client if None.
+    :return: Company Class.
+    """
+    client = get_client(client)
+    cache = client.company_cache()
+    key = cache_key("company:" + query_type, number)
+    r = request_snapshot(cache, key, call)
+    if isinstance(r, Company):
+        return client.index_company(r)
+    raise_for_safer_status(r.status_code, r.reason)
+    company = build_company(
+        r.content,
+        not_found_message,
+        encoding=r.encoding,
+        fetched_at=getattr(r, "stored_at", None),
+        stale=getattr(r, "stale", False),
+    )
+    if cache is not None:
+        cache.set(key, dump_company_record(company.to_dict(), company.content_hash, response_validators(r.headers)))
+    return client.index_company(company)
+
+
+def request_snapshot(cache, key, call):
+    """
+    Requests the snapshot of a Company, conditional on its parsed record in the cache. The record is used instead of
+    the page when SAFER answers 304, and as a fallback when SAFER is unreachable or answers with a server error.
+
+    :param cache: Cache of parsed records, or None.
+    :param key: Key of the record.
+    :param call: Function without arguments that requests the snapshot.
+    :return: Company of the record, or the response whose page is to be parsed.
+    """
+    try:
+        r = call()
+    except UNREACHABLE_ERRORS:
+        # Falling back on an expired record while SAFER is unreachable
+        company = stale_company(cache, key)
+        if company is None:
+            raise
+        return company
+    if r.status_code > 499:
+        # An error from SAFER is answered with the expired record too
+        company = stale_company(cache, key)
+        if company is not None:
+            return company
+    if r.status_code == 304 and cache is not None:
+        # The page is unchanged since the record was parsed, so it's used again without parsing the page
+        value = cache.revalidate(key)
+        record = load_company_record(value) if value is not None else None
+        if record is not None:
+            return record_company(record, time.time())
+        # The record was evicted since the request was made, without it the request isn't conditional
+        r = call()
+    return r
+
+
+def record_company(record, stored_at, stale=False):
+    """
+    :param record: CompanyRecord loaded from the cache of parsed records.
+    :param stored_at: Time in seconds since the epoch the record was stored.
+    :param stale: Whether the record is expired.
+    :return: Company Class.
+    """
+    return Company(data=record.data, content_hash=record.content_hash, fetched_at=stored_at, stale=stale)
+
+
+def stale_company(cache, key):
+    """
+    :param cache: Cache of parsed records, or None.
+    :param key: Key of the record.
+    :return: Company of the record flagged as stale whether it's fresh or not, or None if there is no record.
+    """
+    entry = cache.get_stale_entry(key, decode=load_company_record) if cache is not None else None
+    return record_company(*entry, stale=True) if entry is not None else None
+
+
+def cached_company(usdot, client=None):
+    """
+    Gets a Company from the cache of the client without making a request, whether it caches parsed records or
+    responses.
+
+    :param usdot: USDOT Number.
+    :param client: SaferClient whose cache is used, the default client if None.
+    :return: Company Class, or None if the cache holds no fresh entry for the USDOT Number.
+    """
+    client = get_client(client)
+    cache = client.company_cache()
+    if cache is not None:
+        entry = cache.get_entry(cache_key("company:usdot", usdot), decode=load_company_record)
+        return record_company(*entry) if entry is not None else None
+    if client.cache is not None:
+        entry = client.cache.get_entry(cache_key("usdot", usdot))
+        if entry is not None:
+            return build_company(entry[0], USDOT_NOT_FOUND_MESSAGE, fetched_at=entry[1])
+    return None
+
+
+def resolve_mc_mx(number, client=None):
+    """
+    Resolves an MC/MX Number to a cached Company through the docket index of the client.
+
+    :param number: MC/MX Number.
+    :param client: SaferClient whose docket index and cache are used, the default client if None.
+    :return: Company Class, or None if the number isn't in the index or its Company isn't cached.
+    """
+    index = get_client(client).docket_index
+    if index is None:
+        return None
+    usdot = index.usdot_for_mc_mx(number)
+    if usdot is None:
+        return None
+    company = cached_company(usdot, client)
+    # The docket might have moved to another Company since the cached snapshot was taken
+    dockets = parse_dockets(company.mc_mx_ff_numbers) if company is not None else []
+    if not any(prefix in MC_MX_PREFIXES and n == int(number) for prefix, n in dockets):
+        return None
+    return company
+
 
 class CompanySnapshot:
+    # Size of the chunks the search results page is parsed in by iter_search
+    SEARCH_CHUNK_SIZE = 16 * 1024
+
     def __init__(self):
         pass
 
     @staticmethod
-    def search(name):
+    def search(name, client=None, source="remote", state=None, city=None):  # pylint: disable=too-many-arguments
         """
         Searches the CompanySnapshot using a name,
 
+        With source "local" the search is answered by the local index of the client from the Companies and
+        SearchResults fetched so far, without a request to SAFER, and the results are never truncated. Concurrent
+        remote searches for the same name and filters through the same client share one request.
+
         :param name: A company name.
+        :param client: SaferClient to make the request with, the default client if None.
+        :param source: "remote" to search SAFER, "local" to search the local index.
+        :param state: Two letter state to filter the results by, or None.
+        :param city: City to filter the results by, or None.
         :return: SearchResultSet Class with multiple SearchResults.
         """
         if name == "":
             raise ValueError("'name' parameter must not be empty")
+        if source not in ("remote", "local"):
+            raise ValueError("'source' must be either 'remote' or 'local'")
 
-        # Make request
-        r = api_call_search(name)
-        if r.status_code > 399:
-            raise SAFERUnreachableException(
-                "The SAFER website is currently unreachable with status code: {} {}".format(
-                    r.status_code, r.reason
-                )
-            )
-        # Parse HTML result to tree
-        tree = parse_html_to_tree(r.text)
-        if tree is None or len(tree) == 0:
-            # Parsing will return an empty return set if there are no results
-            return SearchResultSet([], name)
-        # Parse out values from HTML tree
-        search_results = process_search_result_html(tree)
-        return SearchResultSet(search_results, name)
+        index = get_client(client).local_index
+        if source == "local":
+            if index is None:
+                raise ValueError("Searching with source 'local' requires a local index, see set_local_index")
+            return SearchResultSet(index.search(name, state=state, city=city), name, truncated=False)
+
+        def fetch():
+            # Make request
+            r = api_call_search(name, client=client)
+            raise_for_safer_status(r.status_code, r.reason)
+            results = build_search_result_set(r.content, name, state=state, city=city, encoding=r.encoding)
+            if index is not None:
+                # Iterating the SearchResultSet itself would use up its iterator
+                index.add_search_results(results[i] for i in range(len(results)))
+            return results
+
+        # Every caller gets its own copy of the shared SearchResultSet, so each one has its own iterator
+        return copy.copy(get_client(client).flights.do(("search", name, state, city), fetch))
+
+    @staticmethod
+    def iter_search(name, client=None):
+        """
+        Searches the CompanySnapshot using a name, the response is parsed while it's received and the results are
+        yielded as soon as they are parsed, instead of building the whole page first like search() does.
+
+        :param name: A company name.
+        :param client: SaferClient to make the request with, the default client if None.
+        :return: Generator of SearchResults.
+        """
+        if name == "":
+            raise ValueError("'name' parameter must not be empty")
+
+        r = api_call_search_stream(name, client=client)
+        try:
+            raise_for_safer_status(r.status_code, r.reason)
+            chunks = r.iter_content(chunk_size=CompanySnapshot.SEARCH_CHUNK_SIZE)
+            index = get_client(client).local_index
+            for result in iter_search_result_html(chunks, encoding=r.encoding):
+                result = SearchResult(result)
+                if index is not None:
+                    index.add_search_result(result)
+                yield result
+        finally:
+            if hasattr(r, "close"):
+                r.close()
 
     @staticmethod
-    def get_by_mc_mx_number(number):
+    def get_by_mc_mx_number(number, client=None):
         """
-        Gets the Company Snapshot of a given MC/MX Number.
+        Gets the Company Snapshot of a given MC/MX Number. If the client has a docket index that knows the number,
+        the Company is served from the cache under its USDOT Number when it's there. Concurrent calls for the same
+        number through the same client share one request.
 
         :param number: MC/MX Number
+        :param client: SaferClient to make the request with, the default client if None.
         :return: Company Class.
         """
         if isinstance(number, str):
             raise ValueError("parameter 'number' must be an int.")
 
-        r = api_call_get_mcmx(mcmx=number)
-        if r.status_code > 399:
-            raise SAFERUnreachableException(
-                "The SAFER website is currently unreachable with status code: {} {}".format(
-                    r.status_code, r.reason
-                )
-            )
-        # Parse HTML result to tree
-        tree = parse_html_to_tree(r.text)
-        if tree is None or len(tree) == 0:
-            # Parsing will return an empty return set if there are no results
-            raise CompanySnapshotNotFoundException(
-                "The MC or MX number you provided was not found."
+        def fetch():
+            company = resolve_mc_mx(number, client=client)
+            if company is not None:
+                return company
+            return fetch_company(
+                "mc_mx",
+                number,
+                lambda: api_call_get_mcmx(mcmx=number, client=client, conditional=True),
+                MC_MX_NOT_FOUND_MESSAGE,
+                client=client,
             )
-        # Parse out values from HTML tree
-        search_results = process_company_snapshot(tree)
-        return Company(data=search_results)
+
+        return get_client(client).flights.do(("mc_mx", number), fetch)
 
     @staticmethod
-    def get_by_usdot_number(number):
+    def get_by_usdot_number(number, client=None):
         """
-        Gets the Company Snapshot of a given USDOT Number.
+        Gets the Company Snapshot of a given USDOT Number. Concurrent calls for the same number through the same
+        client share one request.
 
         :rtype: Company
         :param number: USDOT Number
+        :param client: SaferClient to make the request with, the default client if None.
         :return: Company class
         """
         if isinstance(number, str):
             raise ValueError("parameter 'number' must be an int.")
 
-        r = api_call_get_usdot(usdot=number)
-        if r.status_code > 399:
-            raise SAFERUnreachableException(
-                "The SAFER website is currently unreachable with status code: {} {}".format(
-                    r.status_code, r.reason
-                )
-            )
-        # Parse HTML result to tree
-        tree = parse_html_to_tree(r.text)
-        if tree is None or len(tree) == 0:
-            # Parsing will return an empty return set if there are no results
-            raise CompanySnapshotNotFoundException(
-                "The USDOT number provided was not found."
-            )
-        # Parse out values from HTML tree
-        search_results = process_company_snapshot(tree)
-        return Company(data=search_results)
+        return get_client(client).flights.do(
+            ("usdot", number),
+            lambda: fetch_company(
+                "usdot",
+                number,
+                lambda: api_call_get_usdot(usdot=number, client=client, conditional=True),
+                USDOT_NOT_FOUND_MESSAGE,
+                client=client,
+            ),
+        )
+
+    @staticmethod
+    def get_many(usdots=(), mc_mx=(), max_workers=8, client=None):
+        """
+        Gets the Company Snapshots of many USDOT and/or MC/MX Numbers using a pool of threads that share one
+        connection pool.
+
+        Results are yielded in the order they complete as (key, result) tuples. The key is ("usdot", number) or
+        ("mc_mx", number), the result is a Company or the exception raised while getting it, so one failed lookup
+        doesn't abort the rest of the batch.
+
+        :param usdots: Iterable of USDOT Numbers.
+        :param mc_mx: Iterable of MC/MX Numbers.
+        :param max_workers: Number of lookups to run at the same time.
+        :param client: SaferClient to make the requests with, the default client if None.
+        :return: Generator of (key, Company or Exception) tuples.
+        """
+        jobs = [(("usdot", number), CompanySnapshot.get_by_usdot_number) for number in usdots]
+        jobs += [(("mc_mx", number), CompanySnapshot.get_by_mc_mx_number) for number in mc_mx]
+
+        get_client(client).ensure_pool_size(max_workers)
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            futures = {executor.submit(lookup, key[1], client): key for key, lookup in jobs}
+            for future in as_completed(futures):
+                exception = future.exception()
+                yield futures[future], exception if exception is not None else future.result()
+        finally:
+            # If the caller stopped iterating early, the queued lookups are cancelled and only the running ones are
+            # waited for
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    @staticmethod
+    def refresh(companies, max_workers=8, client=None):
+        """
+        Refreshes Companies that were fetched before, using a pool of threads like get_many. Pages that didn't change
+        since the Companies were fetched are not parsed, see refresh_company.
+
+        Only the Companies that changed or couldn't be refreshed are yielded, in the order they complete, as
+        CompanyDiffs. The diff holds the refreshed Company and a FieldChange for every field that changed, or the
+        exception raised while refreshing it in `error`.
+
+        :param companies: Iterable of Companies.
+        :param max_workers: Number of Companies to refresh at the same time.
+        :param client: SaferClient to make the requests with, the default client if None.
+        :return: Generator of CompanyDiffs.
+        """
+        get_client(client).ensure_pool_size(max_workers)
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            futures = {executor.submit(refresh_company, company, client): company for company in companies}
+            for future in as_completed(futures):
+                exception = future.exception()
+                if exception is not None:
+                    yield CompanyDiff(int(futures[future].usdot), None, [], exception)
+                elif future.result() is not None:
+                    yield future.result()
+        finally:
+            # Like get_many, queued refreshes are cancelled and running ones are waited for
+            executor.shutdown(wait=True, cancel_futures=True)
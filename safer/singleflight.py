@@ -0,0 +1,118 @@
+import asyncio
+import threading
+
+
+class _Call:  # pylint: disable=too-few-public-methods
+    """
+    A call in flight, the callers waiting on it are woken up once `done` is set.
+    """
+
+    __slots__ = ("result", "error", "done")
+
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class SingleFlight:  # pylint: disable=too-few-public-methods
+    """
+    Coalesces concurrent calls with the same key: while a call for a key is in flight, other threads asking for the
+    same key wait for its result instead of making the call themselves. Results aren't kept once the call is done,
+    that's what the caches are for.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self.__calls = {}
+        self.__lock = threading.Lock()
+
+    def do(self, key, func):
+        """
+        :param key: Hashable key of the call.
+        :param func: Function without arguments that makes the call.
+        :return: The result of the call, shared by every caller that waited on it.
+        :raises Exception: The exception raised by the call, raised in every caller that waited on it.
+        """
+        with self.__lock:
+            call = self.__calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.__calls[key] = _Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+            call.done.set()
+        return call.result
+
+
+class _AsyncCall:  # pylint: disable=too-few-public-methods
+    """
+    A call in flight in its own task, shared by the tasks awaiting it.
+    """
+
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class AsyncSingleFlight:  # pylint: disable=too-few-public-methods
+    """
+    asyncio version of SingleFlight, the call is made in a task of its own that concurrent tasks asking for the same
+    key all await. A task that's cancelled stops waiting without cancelling the call for the others, the call is only
+    cancelled once every task awaiting it was.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self.__calls = {}
+
+    async def do(self, key, func):
+        """
+        :param key: Hashable key of the call.
+        :param func: Coroutine function without arguments that makes the call.
+        :return: The result of the call, shared by every task that awaited it.
+        :raises Exception: The exception raised by the call, raised in every task that awaited it.
+        """
+        call = self.__calls.get(key)
+        if call is not None:
+            self.coalesced += 1
+        else:
+            call = self.__calls[key] = _AsyncCall(asyncio.get_running_loop().create_task(func()))
+            call.task.add_done_callback(lambda task: self.__done(key, call))
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # Nobody is left to get the result
+                self.__forget(key, call)
+                call.task.cancel()
+
+    def __done(self, key, call):
+        self.__forget(key, call)
+        if not call.task.cancelled():
+            # Marks the exception as retrieved, there might be nobody left awaiting it
+            call.task.exception()
+
+    def __forget(self, key, call):
+        if self.__calls.get(key) is call:
+            del self.__calls[key]
@@ -15,6 +15,8 @@ setup(
     author="Arthur Tyukayev",
     author_email="arthurtyukayev@gmail.com",
     install_requires=["lxml", "requests", "python-dateutil"],
+    extras_require={"async": ["aiohttp"], "arrow": ["pyarrow"], "otel": ["opentelemetry-api"]},
+    entry_points={"console_scripts": ["safer-crawl=safer.crawl:main"]},
     license="MIT",
     long_description=long_description,
     long_description_content_type="text/markdown",